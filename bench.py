@@ -0,0 +1,330 @@
+###############################################################################
+#                                                                             #
+# Benchmarks for the hot paths of REP-X. Run python bench.py --help.          #
+#                                                                             #
+###############################################################################
+
+import sys,json,time,random,argparse,resource,platform,contextlib,multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import blast
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.httpclient import AsyncHTTPClient
+from tornado.testing import bind_unused_port
+try:
+    #An in-process stand-in for the redis server
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+Residues = 'ACDEFGHIKLMNPQRSTVWY'
+
+def synthetic_query(length, rng):
+    """synthetic_query(int, random.Random): a random protein sequence"""
+    return ''.join([rng.choice(Residues) for i in range(length)])
+
+def synthetic_hits(query, nhits, rng, identity=0.6, gaps=0.02):
+    """
+    Parameters
+    ----------
+    query : str
+    nhits : int
+    rng : random.Random
+    identity : float (optional)
+        Fraction of aligned positions at which a hit keeps the query residue
+    gaps : float (optional)
+        Chance of a gap in either sequence at each aligned position
+    Returns
+    -------
+    hits : list
+        Hit dicts in the form format_blast_xml and iterparse_hits use, aligned to random stretches of the query
+        and with descending scores
+    """
+    hits = []
+    for i in range(nhits):
+        start = rng.randint(1, max(1, len(query)//4))
+        stop = rng.randint(min(len(query), 3*len(query)//4), len(query))
+        qseq,hseq = [],[]
+        for residue in query[start-1:stop]:
+            if rng.random() < gaps:
+                #An insertion in the hit
+                qseq.append('-')
+                hseq.append(rng.choice(Residues))
+            qseq.append(residue)
+            if rng.random() < gaps:
+                hseq.append('-')
+            else:
+                hseq.append(residue if rng.random() < identity else rng.choice(Residues))
+        hits.append({
+            'accession'  : 'XP_{:06d}'.format(i),
+            'definition' : 'synthetic protein {} [Homo sapiens]'.format(i),
+            'score'      : 2000 - 2000*i//nhits,
+            'query_from' : start,
+            'query_to'   : stop,
+            'qseq'       : ''.join(qseq),
+            'hseq'       : ''.join(hseq),
+        })
+    return hits
+
+def synthetic_xml(nhits, query_length, nqueries=1, seed=0):
+    """
+    Parameters
+    ----------
+    nhits : int
+        Hits per query
+    query_length : int
+    nqueries : int (optional)
+        Number of <Iteration>s, as in a multi-FASTA search
+    seed : int (optional)
+    Returns
+    -------
+    XML : str
+        BLAST XML written by blast.format_blast_xml
+    queries : list
+        The query sequences
+    """
+    rng = random.Random(seed)
+    queries = [synthetic_query(query_length, rng) for i in range(nqueries)]
+    iterations = [("Query_{}".format(i), query_length, synthetic_hits(q, nhits, rng)) for i,q in enumerate(queries, 1)]
+    return blast.format_blast_xml(iterations), queries
+
+def timeit(fn, repeat=3):
+    """timeit(function, int): summary statistics in seconds of repeat calls of fn()"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times)), 'repeat': repeat}
+
+def bench_results(nhits, query_length, repeat=3, seed=0):
+    """
+    Time parsing, serializing, mutant recommendation and alignment formatting for one synthetic result
+
+    Returns
+    -------
+    timings : dict
+    """
+    xml,(query,) = synthetic_xml(nhits, query_length, seed=seed)
+    rng = random.Random(seed)
+    results = blast.blast_results(xml, query=query)
+    packed = blast.dumps(results)
+    #Sets of one to three residues as a user would tick them
+    residue_sets = [rng.sample(range(1, query_length + 1), rng.randint(1, 3)) for i in range(100)]
+    hits = [results.hit(i) for i in range(min(100, nhits))]
+
+    return {
+        'hits'             : nhits,
+        'query_length'     : query_length,
+        'xml_bytes'        : len(xml),
+        'packed_bytes'     : len(packed),
+        'parse'            : timeit(lambda: blast.blast_results(xml, query=query), repeat),
+        'loads'            : timeit(lambda: blast.loads(packed), repeat),
+        #Per call averages over the residue sets and hits
+        'recommend_mutant' : per_call(timeit(lambda: [results.recommend_mutant(i) for i in residue_sets], repeat), len(residue_sets)),
+        'format_alignment' : per_call(timeit(lambda: [blast.format_alignment(h.qseq, h.hseq) for h in hits], repeat), len(hits)),
+    }
+
+def per_call(timing, calls):
+    """per_call(dict, int): timing of a loop over calls calls divided into the timing of one call"""
+    return dict({k: v/calls for k,v in timing.items() if k != 'repeat'}, repeat=timing['repeat'], calls=calls)
+
+def percentiles(latencies):
+    """percentiles(list): summary of a list of latencies in seconds"""
+    if len(latencies) == 0:
+        return {'count': 0}
+    p50,p90,p99 = np.percentile(latencies, [50, 90, 99])
+    return {'count': len(latencies), 'mean': float(np.mean(latencies)), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(np.max(latencies))}
+
+async def load_test(nhits, query_length, clients=10, requests=50, sequences=None, seed=0, redis_db=None):
+    """
+    Drive the handlers of server.py end to end against mock_ncbi and a redis stand-in on this IOLoop. Each
+    request submits a sequence, long polls until its results are in, loads the residue picker, asks for a mutant
+    and downloads the conservation profile.
+
+    Parameters
+    ----------
+    nhits : int
+        Hits in the results mock_ncbi returns
+    query_length : int
+    clients : int (optional)
+        Number of requests in flight at once
+    requests : int (optional)
+        Number of requests
+    sequences : int (optional)
+        Number of distinct sequences submitted. Repeats are answered by deduplication. Defaults to requests.
+    seed : int (optional)
+    redis_db : int (optional)
+        A database of the redis server in server.py to run against instead of fakeredis. It is emptied first.
+        Without fakeredis it is required.
+    Returns
+    -------
+    report : dict
+        Throughput and the latency percentiles of each step
+    """
+    import server, mock_ncbi
+    if redis_db is not None:
+        print("Emptying database {} of the redis server at {}:{} for the load test".format(redis_db, server.redis_url, server.redis_port))
+        db = server.CountedRedis(host=server.redis_url, port=server.redis_port, db=redis_db)
+        db.flushdb()
+    elif fakeredis is not None:
+        db = server.CountedRedis(connection_pool=fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()).connection_pool)
+    else:
+        raise ValueError("fakeredis is not installed. Choose a redis database the load test may empty with redis_db.")
+
+    xml,_ = synthetic_xml(nhits, query_length, seed=seed)
+    sock,port = bind_unused_port()
+    mock = HTTPServer(mock_ncbi.make_app(xml))
+    mock.add_sockets([sock])
+    blast.BlastURL = "http://127.0.0.1:{}/blast/Blast.cgi".format(port)
+
+    application,scheduler,notifier = server.make_app(db)
+    scheduler.period,scheduler.interval = 0.05,0
+    sock,port = bind_unused_port()
+    http = HTTPServer(application)
+    http.add_sockets([sock])
+    url = "http://127.0.0.1:{}".format(port)
+    scheduler.start(tick=0.05)
+    notifier.start()
+
+    rng = random.Random(seed)
+    pool = [synthetic_query(query_length, rng) for i in range(sequences or requests)]
+    #Its own client, the shared one is reserved for the requests the server makes to mock_ncbi
+    client = AsyncHTTPClient(force_instance=True, max_clients=clients)
+    latencies = {'submit': [], 'wait': [], 'sequence': [], 'recommend': [], 'profile': []}
+    errors = []
+
+    async def timed(step, *args, **kw):
+        start = time.perf_counter()
+        response = await client.fetch(*args, raise_error=False, follow_redirects=False, request_timeout=600, **kw)
+        latencies[step].append(time.perf_counter() - start)
+        if response.code >= 400:
+            errors.append((step, response.code))
+        return response
+
+    async def workflow(i):
+        seq = pool[i % len(pool)]
+        response = await timed('submit', url + '/', method='POST', body='usersequence=' + seq)
+        location = response.headers.get('Location', '')
+        if location.startswith('/sequence/'):
+            uid = location.split('/')[2]
+        else:
+            uid = response.body.decode().split("/notify/", 1)[1].split("'", 1)[0]
+            start = time.perf_counter()
+            while not location.startswith('/sequence/'):
+                response = await client.fetch(url + '/blast/' + uid, raise_error=False, follow_redirects=False, request_timeout=600)
+                location = response.headers.get('Location', '')
+                if location == '/':
+                    errors.append(('wait', 'missing'))
+                    return
+            latencies['wait'].append(time.perf_counter() - start)
+        await timed('sequence', url + '/sequence/' + uid)
+        residues = rng.sample(range(1, query_length + 1), rng.randint(1, 3))
+        await timed('recommend', url + '/sequence/' + uid, method='POST', body='&'.join(['mutant={}'.format(r) for r in residues]))
+        await timed('profile', url + '/sequence/{}/profile'.format(uid))
+
+    queue = list(range(requests))
+    async def worker():
+        while len(queue) > 0:
+            await workflow(queue.pop(0))
+
+    start = time.perf_counter()
+    await gen.multi([worker() for i in range(clients)])
+    elapsed = time.perf_counter() - start
+
+    scheduler.stop()
+    notifier.stop()
+    http.stop()
+    mock.stop()
+    client.close()
+    if server.CPU_POOL is not None:
+        #Wait for the pool so its processes count towards peak_rss
+        server.CPU_POOL.shutdown()
+        server.CPU_POOL = None
+    return {
+        'hits'         : nhits,
+        'query_length' : query_length,
+        'clients'      : clients,
+        'requests'     : requests,
+        'sequences'    : len(pool),
+        'cpu_workers'  : server.cpu_workers,
+        'elapsed'      : elapsed,
+        'throughput'   : requests/elapsed,
+        'errors'       : len(errors),
+        'latency'      : {k: percentiles(v) for k,v in latencies.items()},
+    }
+
+def run_load_test(*args):
+    """run_load_test(*args): load_test(*args) run on a new IOLoop with the server's log kept off stdout"""
+    #The server logs to stdout, keep it clear for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        return IOLoop.current().run_sync(lambda: load_test(*args))
+
+def peak_rss():
+    """peak_rss(): the peak resident set size in bytes of this process and of its largest finished child"""
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self'     : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale,
+        'children' : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale,
+    }
+
+def measured(fn, *args):
+    """measured(function, *args): the report fn(*args) returns with the peak_rss of the process it ran in"""
+    report = fn(*args)
+    report['peak_rss'] = peak_rss()
+    return report
+
+def stage(fn, *args):
+    """
+    Run the benchmark fn(*args) in a new process so that its peak_rss is its own and not that of the stages 
+    before it. The new process imports numpy and blast before fn runs, so each peak includes them.
+
+    Returns
+    -------
+    report : dict
+        The report of fn with its peak_rss
+    """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(measured, fn, *args).result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the hot paths of REP-X and write the results as JSON")
+    parser.add_argument('--hits', type=int, nargs='+', default=[1000, 3000, 20000], help="hit counts to benchmark")
+    parser.add_argument('--query-length', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=3, help="repeats of each timing")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--load', action='store_true', help="also load test the handlers against mock_ncbi")
+    parser.add_argument('--load-hits', type=int, default=3000, help="hits in the results of the load test")
+    parser.add_argument('--clients', type=int, default=10, help="concurrent requests in the load test")
+    parser.add_argument('--requests', type=int, default=50, help="requests in the load test")
+    parser.add_argument('--sequences', type=int, default=None, help="distinct sequences in the load test")
+    parser.add_argument('--redis-db', type=int, default=None, help="run the load test on this database of the redis server, which it empties, instead of fakeredis")
+    parser.add_argument('--output', default=None, help="write the JSON here instead of to stdout")
+    args = parser.parse_args(argv)
+    if args.load and args.redis_db is None and fakeredis is None:
+        parser.error("the load test needs fakeredis, or --redis-db with a redis database it may empty")
+
+    report = {
+        'time'     : time.time(),
+        'python'   : platform.python_version(),
+        'platform' : platform.platform(),
+        'results'  : [],
+    }
+    for nhits in args.hits:
+        print("Timing results with {} hits".format(nhits), file=sys.stderr)
+        report['results'].append(stage(bench_results, nhits, args.query_length, args.repeat, args.seed))
+    if args.load:
+        print("Load testing with {} hits".format(args.load_hits), file=sys.stderr)
+        report['load'] = stage(run_load_test, args.load_hits, args.query_length, args.clients, args.requests, args.sequences, args.seed, args.redis_db)
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
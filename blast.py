@@ -4,19 +4,109 @@
 #                                                                             #
 ###############################################################################
 
-import re,subprocess,requests,datetime
-from bs4 import BeautifulSoup
+import io,os,re,struct,time,uuid,shutil,sqlite3,subprocess,threading,requests,datetime
+import numpy as np
+import metrics
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from urllib.parse import urlencode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from tornado import gen
+from tornado.httpclient import HTTPClientError
+try:
+    #async_blast_handle needs libcurl to reuse connections, tornado's own client does not. The rest of the module works without it.
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
 
 AminoAcids = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y', 
               'a', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'k', 'l', 'm', 'n', 'p', 'q', 'r', 's', 't', 'v', 'w', 'y']
 
+#Lookup table from ascii codes to membership in AminoAcids
+IsAminoAcid = np.zeros(256, dtype=bool)
+IsAminoAcid[[ord(i) for i in AminoAcids]] = True
+Gap = ord('-')
+
+#The columns of a conservation profile: the amino acids, then gaps, then anything else (X, B, Z, *, ...)
+ProfileAlphabet = 'ACDEFGHIKLMNPQRSTVWY-X'
+#Lookup table from ascii codes to profile columns. Lower case residues are counted with upper case ones.
+ProfileIndex = np.full(256, len(ProfileAlphabet) - 1, dtype=np.intp)
+ProfileIndex[[ord(i) for i in ProfileAlphabet[:21]]] = np.arange(21)
+ProfileIndex[[ord(i.lower()) for i in ProfileAlphabet[:20]]] = np.arange(20)
+ProfileChunkSize = 4096 #Alignment rows counted at a time by conservation_profile
+
+#The NCBI BLAST url api endpoint. Point this at a stand-in server (see mock_ncbi.py) to run offline.
+BlastURL = "https://www.ncbi.nlm.nih.gov/blast/Blast.cgi"
+NCBIMaxConnections = 4 #Maximum simultaneous connections held open by the async client
+#libcurl errors raised before any of a request is sent (could not resolve the host, could not connect)
+CurlNotSentErrors = (6, 7)
+
+EfetchURL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+EfetchBatchSize = 200 #Accessions per efetch request
+EfetchWorkers = 3 #Concurrent efetch requests
+EfetchRate = 3 #Maximum efetch requests per second -- NCBI allows three without an api key
+SequenceCachePath = "sequences.sqlite" #Where sequence_cache keeps full length sequences
+
+LocalDatabase = "proteins.fasta" #The database local_handle searches by default
+LocalResultsDir = "local_results" #Where local_handle writes the XML of finished searches
+LocalWorkers = 2 #Size of the process pool local searches run on
+LocalChunkSize = 2000 #Database sequences aligned per batch by the in-repo aligner
+LocalPool = None
+
+ExportFormats = ('fasta', 'aligned') #Formats blast_results.export writes
+
+PutKwargs = ['AUTO_FORMAT', 'COMPOSITION_BASED_STATISTICS', 'DATABASE', 'DB_GENETIC_CODE', 'ENDPOINTS', 'ENTREZ_QUERY', 'EXPECT', 'FILTER', 'FORMAT_TYPE', 'GAPCOSTS', 'GENETIC_CODE', 'HITLIST_SIZE', 'I_THRESH', 'LAYOUT', 'LCASE_MASK', 'MATRIX_NAME', 'NUCL_PENALTY', 'NUCL_REWARD', 'OTHER_ADVANCED', 'PERC_IDENT', 'PHI_PATTERN', 'PROGRAM', 'QUERY', 'QUERY_FILE', 'QUERY_BELIEVE_DEFLINE', 'QUERY_FROM', 'QUERY_TO', 'SEARCHSP_EFF', 'SERVICE', 'THRESHOLD', 'UNGAPPED_ALIGNMENT', 'WORD_SIZE']
+GetKwargs = ['ALIGNMENTS', 'ALIGNMENT_VIEW', 'DESCRIPTIONS', 'ENTREZ_LINKS_NEW_WINDOW', 'EXPECT_LOW', 'EXPECT_HIGH', 'FORMAT_ENTREZ_QUERY', 'FORMAT_OBJECT', 'FORMAT_TYPE', 'NCBI_GI', 'RID', 'RESULTS_FILE', 'SERVICE', 'SHOW_OVERVIEW']
+
+NCBISeconds = metrics.timer('repx_ncbi_seconds', "Time spent in blast_handle and async_blast_handle methods talking to NCBI")
+EfetchSeconds = metrics.timer('repx_efetch_seconds', "Time spent on each efetch request")
+ParseSeconds = metrics.timer('repx_parse_seconds', "Time spent parsing BLAST XML into blast_results")
+RecommendSeconds = metrics.timer('repx_recommend_mutant_seconds', "Time spent in blast_results.recommend_mutant")
+AlignSeconds = metrics.timer('repx_align_seconds', "Time spent in smith_waterman.align")
+
 class ConnectivityError(Exception):
     """
     This is just a dummy class to help diagnose the source of an error. It may do more later.
     """
     pass
 
-class blast_handle():
+class SearchFailed(Exception):
+    """
+    Raised when a search has ended without results, for instance when NCBI reports its status as FAILED. Unlike
+    ConnectivityError, checking again will not help.
+    """
+    pass
+
+class search_backend():
+    """
+    The interface shared by every way of running a search. A backend is constructed with the query, submitted
+    with request, polled with check_status and its BLAST XML is downloaded with fetch_result. blast_handle and 
+    async_blast_handle run searches on NCBI's servers and local_handle runs them against a local database.
+    """
+    def __init__(self, query):
+        self.query  = query
+        self.status = None
+        self.rid    = None
+
+    def request(self, **kw):
+        """
+        Submit the search and return the tuple (RID, WAITTIME). See blast_handle.request for the arguments.
+        """
+        raise NotImplementedError()
+
+    def check_status(self):
+        """
+        Return True if the search identified by self.rid has finished and False otherwise
+        """
+        raise NotImplementedError()
+
+    def fetch_result(self, **kw):
+        """
+        Return the results of the finished search as BLAST XML
+        """
+        raise NotImplementedError()
+
+class blast_handle(search_backend):
     """
     This class is used to make calls to the NCBI
     BLAST common url api (https://blast.ncbi.nlm.nih.gov/Blast.cgi?CMD=Web&PAGE_TYPE=BlastDocs&DOC_TYPE=DeveloperInfo) 
@@ -29,10 +119,9 @@ class blast_handle():
             The query for your blast search. Usually this will be a bare sequence, but users may also supply an 
             NCBI accession, GI, or FASTA
         """
-        self.query  = query
-        self.status = None
-        self.rid    = None
+        super().__init__(query)
 
+    @metrics.timed(NCBISeconds, method='request')
     def request(self, **kw):
         """
         Parameters
@@ -43,7 +132,8 @@ class blast_handle():
             are reproduced here. Any properly formatted api option is supported.
 
                 QUERY : string, default=self.query TODO: this needs to be seq basically always
-                    Accession, GI, or FASTA.
+                    Accession, GI, or FASTA. A multi-FASTA query is searched as one request with one <Iteration> 
+                    per sequence in the results (see split_iterations).
                 DATABASE : string, default='nr'
                     Blast database to use for this query
                 PROGRAM BLAST : string, default='blastp'
@@ -60,8 +150,16 @@ class blast_handle():
             The number of seconds NCBI estimates your request will take. 
         """
 
-        PutKwargs = ['AUTO_FORMAT', 'COMPOSITION_BASED_STATISTICS', 'DATABASE', 'DB_GENETIC_CODE', 'ENDPOINTS', 'ENTREZ_QUERY', 'EXPECT', 'FILTER', 'FORMAT_TYPE', 'GAPCOSTS', 'GENETIC_CODE', 'HITLIST_SIZE', 'I_THRESH', 'LAYOUT', 'LCASE_MASK', 'MATRIX_NAME', 'NUCL_PENALTY', 'NUCL_REWARD', 'OTHER_ADVANCED', 'PERC_IDENT', 'PHI_PATTERN', 'PROGRAM', 'QUERY', 'QUERY_FILE', 'QUERY_BELIEVE_DEFLINE', 'QUERY_FROM', 'QUERY_TO', 'SEARCHSP_EFF', 'SERVICE', 'THRESHOLD', 'UNGAPPED_ALIGNMENT', 'WORD_SIZE']
+        data = self.put_data(**kw)
+        print(BlastURL, data)
+        html = requests.post(BlastURL, data=data).content.decode('utf-8')
+        return self.parse_put(html)
 
+    def put_data(self, **kw):
+        """
+        Build the form data for a Put request. The arguments and defaults are those of blast_handle.request. Put
+        requests are sent as POSTs so that long (e.g. multi-FASTA) queries are not limited by the url length.
+        """
         #Default keyword arguments
         kw['QUERY'] = kw.get("QUERY", self.query)
         kw['FORMAT_TYPE'] = kw.get("FORMAT_TYPE", 'XML')
@@ -73,15 +171,17 @@ class blast_handle():
             if kwarg not in PutKwargs:
                 raise TypeError("blast_handle.request got an unexpected keyword argument {}".format(kwarg))
 
-        BaseURL = "https://www.ncbi.nlm.nih.gov/blast/Blast.cgi?CMD=Put&"
-        QueryString = '&'.join(['='.join((i, str(kw[i]))) for i in PutKwargs if i in kw])
-        
-        #U  = urllib3.urlopen(BaseURL + QueryString)
-        #html = U.read()
-        url = BaseURL + QueryString
-        print(url)
-        html = requests.get(url).content.decode('utf-8')
+        data = {'CMD' : 'Put'}
+        data.update([(i, str(kw[i])) for i in PutKwargs if i in kw])
+        return data
+
+    def parse_put(self, html):
+        """
+        Read the RID and WAITTIME out of the QBlastInfo block of a Put response and set self.rid
+        """
         QBlastInfo = re.search(r"\<\!\-\-QBlastInfoBegin.+QBlastInfoEnd", html, re.DOTALL)
+        if QBlastInfo is None:
+            raise ConnectivityError("The BLAST server did not return a QBlastInfo block")
         QBlastInfo = QBlastInfo.group()
         RID        = QBlastInfo.split()[3]
         WAITTIME   = QBlastInfo.split()[6]
@@ -93,6 +193,7 @@ class blast_handle():
         self.rid = RID
         return RID, WAITTIME
 
+    @metrics.timed(NCBISeconds, method='check_status')
     def check_status(self):
         """
         Query the NCBI database to check the status of self.rid which is the ncbi server
@@ -112,19 +213,29 @@ class blast_handle():
         #This test relies on the idea that qblast only returns FORMAT_TYPE==XML
         #if the search is __complete__. Otherwise, we get an html waiting page
             text = self.ncbi_get(RID = self.rid, FORMAT_OBJECT="SearchInfo")
-            status = text.split("QBlastInfoBegin")[1].split('\n')[1].split('=')[-1]
-            print(status)
-            if status=='WAITING': 
-                self.status = False
-                return False
-            elif status=='UNKNOWN':
-                self.status = False
-                return False
-            elif status=='READY':
-                self.status = True
-                return True
-            else:
-                raise ValueError('The status could not be determined')
+            return self.parse_status(text)
+
+    def parse_status(self, text):
+        """
+        Read the status out of a SearchInfo response, set self.status and return it
+        """
+        if "QBlastInfoBegin" not in text:
+            raise ConnectivityError("The BLAST server did not return a QBlastInfo block")
+        status = text.split("QBlastInfoBegin")[1].split('\n')[1].split('=')[-1].strip()
+        print(status)
+        if status=='WAITING': 
+            self.status = False
+            return False
+        elif status=='UNKNOWN':
+            self.status = False
+            return False
+        elif status=='READY':
+            self.status = True
+            return True
+        elif status=='FAILED':
+            raise SearchFailed('The BLAST search {} failed'.format(self.rid))
+        else:
+            raise ValueError('The status could not be determined')
 
     def fetch_result(self, **kw):
         """
@@ -144,6 +255,7 @@ class blast_handle():
 
         return self.ncbi_get(**kw)
 
+    @metrics.timed(NCBISeconds, method='ncbi_get')
     def ncbi_get(self, **kw):
         """
         make an arbitrary ncbi get request
@@ -155,17 +267,20 @@ class blast_handle():
             documented one the NCBI github (https://ncbi.github.io/blast-cloud/dev/api.html). The default values are:
 
         """
-        BaseURL = "https://www.ncbi.nlm.nih.gov/blast/Blast.cgi?CMD=Get&"
-        GetKwargs = ['ALIGNMENTS', 'ALIGNMENT_VIEW', 'DESCRIPTIONS', 'ENTREZ_LINKS_NEW_WINDOW', 'EXPECT_LOW', 'EXPECT_HIGH', 'FORMAT_ENTREZ_QUERY', 'FORMAT_OBJECT', 'FORMAT_TYPE', 'NCBI_GI', 'RID', 'RESULTS_FILE', 'SERVICE', 'SHOW_OVERVIEW']
+        url = self.get_url(**kw)
+        print(url)
+        return requests.get(url).content.decode('utf-8')
 
+    def get_url(self, **kw):
+        """
+        Build the url for a Get request. The arguments are those of blast_handle.ncbi_get.
+        """
         for kwarg in kw:
             if kwarg not in GetKwargs:
                 raise TypeError("blast_handle.fetch_result got an unexpected keyword argument {}".format(kwarg))
         kw['RID'] = kw.get('RID', self.rid)
         QueryString = '&'.join(['='.join((i, str(kw[i]))) for i in GetKwargs if i in kw])
-        #URL = urllib3.urlopen(BaseURL + QueryString)
-        print(BaseURL + QueryString)
-        return requests.get(BaseURL + QueryString).content.decode('utf-8')
+        return BlastURL + "?CMD=Get&" + QueryString
 
     def __exit__(self):
         """
@@ -176,52 +291,526 @@ class blast_handle():
         RID : the request ID you wish to delete
         """
         if self.rid != None:
-            BaseURL = "https://www.ncbi.nlm.nih.gov/blast/Blast.cgi?CMD=Delete&"
-            #URL = urllib3.urlopen(BaseURL + "RID=%s" %RID)
-            #URL.read()
-            requests.get(BaseURL + "RID=%s" %RID).content.decode('utf-8')
+            requests.get(BlastURL + "?CMD=Delete&RID=%s" %self.rid).content.decode('utf-8')
+
+class async_blast_handle(blast_handle):
+    """
+    A non-blocking blast_handle for use inside tornado coroutines. request, check_status, fetch_result and 
+    ncbi_get are coroutines with the same arguments and return values as their blast_handle counterparts.
+    All handles share one http client per IOLoop, which keeps connections to NCBI alive between requests and 
+    needs pycurl. Failed requests are retried with exponential backoff.
+    """
+    def __init__(self, query, timeout=60., retries=3, backoff=2.):
+        """
+        Parameters
+        ----------
+        query : string
+            The query for your blast search. See blast_handle.
+        timeout : float (optional)
+            Seconds to wait for each http request to complete
+        retries : int (optional)
+            Number of times to retry a request which timed out, could not connect or got a server error
+        backoff : float (optional)
+            Seconds to wait before the first retry. The wait doubles with every subsequent retry.
+        """
+        super().__init__(query)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    @metrics.timed(NCBISeconds, method='request')
+    async def request(self, **kw):
+        data = self.put_data(**kw)
+        print(BlastURL, data)
+        return self.parse_put(await self.fetch(BlastURL, urlencode(data)))
+
+    @metrics.timed(NCBISeconds, method='check_status')
+    async def check_status(self):
+        if self.rid is None:
+            self.status = None
+            raise TypeError('The type of self.rid is None. Run self.blast_request() before checking status.')
+        text = await self.ncbi_get(RID = self.rid, FORMAT_OBJECT="SearchInfo")
+        return self.parse_status(text)
+
+    async def fetch_result(self, **kw):
+        kw['FORMAT_TYPE'] = kw.get('FORMAT_TYPE', 'XML')
+        self.status = self.status if self.status==True else await self.check_status()
+        if self.status != True:
+            raise ValueError("blast_handle.check_status() = {}. Status must be True if the results are ready to be downloaded from NCBI.".format(self.status))
+        return await self.ncbi_get(**kw)
+
+    @metrics.timed(NCBISeconds, method='ncbi_get')
+    async def ncbi_get(self, **kw):
+        url = self.get_url(**kw)
+        print(url)
+        return await self.fetch(url)
+
+    async def fetch(self, url, body=None):
+        """
+        GET url, or POST body to it, and return the decoded response, retrying transient failures. A POST starts a
+        search, so it is only retried if the server answered that it did not take it (5xx or 429) or if it could
+        not be reached at all. One that timed out may have started a search and is not sent again.
+
+        Parameters
+        ----------
+        url : str
+        body : str (optional)
+            Form encoded data to POST
+        Returns
+        -------
+        text : str
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = await http_client().fetch(
+                    url, method='GET' if body is None else 'POST', body=body, 
+                    connect_timeout=self.timeout, request_timeout=self.timeout,
+                )
+                return response.body.decode('utf-8')
+            except HTTPClientError as e:
+                #599 is used by tornado for timeouts and dropped connections
+                sent = e.code != 599 or getattr(e, 'errno', None) not in CurlNotSentErrors
+                if e.code < 500 and e.code != 429 or e.code == 599 and body is not None and sent or attempt == self.retries:
+                    raise ConnectivityError("Request to {} failed: {}".format(url, e)) from e
+            except OSError as e:
+                if attempt == self.retries:
+                    raise ConnectivityError("Request to {} failed: {}".format(url, e)) from e
+            print("Retrying {} in {} seconds".format(url, self.backoff * 2**attempt))
+            await gen.sleep(self.backoff * 2**attempt)
+
+def http_client():
+    """
+    Returns
+    -------
+    client : tornado.curl_httpclient.CurlAsyncHTTPClient
+        The http client shared by every async_blast_handle on the current IOLoop
+    """
+    if CurlAsyncHTTPClient is None:
+        raise ImportError("async_blast_handle needs pycurl to keep connections to NCBI alive. Install it with conda install pycurl")
+    return CurlAsyncHTTPClient(max_clients=NCBIMaxConnections)
+
+class local_handle(search_backend):
+    """
+    Run searches against a protein database on local disk instead of NCBI. Searches run on a bounded pool of 
+    LocalWorkers processes. If the blastp executable is on the PATH it is used, otherwise hits are found with the
+    in-repo smith_waterman aligner. Either way the results are BLAST XML, written to LocalResultsDir/<RID>.xml, 
+    so any process sharing the directory can check on and fetch them. All methods return immediately. Nothing 
+    removes the files of finished searches except clean_local_results.
+    """
+    def __init__(self, query, database=None, results_dir=None):
+        """
+        Parameters
+        ----------
+        query : string
+            A bare sequence or FASTA. Multi-FASTA queries produce one <Iteration> per sequence.
+        database : string (optional)
+            A FASTA file of protein sequences, or the name of a blast database made from it with makeblastdb.
+            Defaults to LocalDatabase.
+        results_dir : string (optional)
+            Defaults to LocalResultsDir
+        """
+        super().__init__(query)
+        self.database = LocalDatabase if database is None else database
+        self.results_dir = LocalResultsDir if results_dir is None else results_dir
+
+    def path(self, extension='xml'):
+        return os.path.join(self.results_dir, "{}.{}".format(self.rid, extension))
+
+    def request(self, **kw):
+        """
+        Submit the search to the local worker pool. QUERY and HITLIST_SIZE are used, the remaining blast_handle.request
+        keywords are accepted for compatibility and ignored.
+        """
+        for kwarg in kw:
+            if kwarg not in PutKwargs:
+                raise TypeError("local_handle.request got an unexpected keyword argument {}".format(kwarg))
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.rid = "LOCAL-" + uuid.uuid4().hex
+        local_pool().submit(local_search, kw.get('QUERY', self.query), self.database, self.path(), int(kw.get('HITLIST_SIZE', 3000)))
+        return self.rid, 0
+
+    def check_status(self):
+        if self.rid is None:
+            self.status = None
+            raise TypeError('The type of self.rid is None. Run self.request() before checking status.')
+        if os.path.exists(self.path('err')):
+            raise SearchFailed("Local search {} failed: {}".format(self.rid, open(self.path('err')).read()))
+        self.status = os.path.exists(self.path())
+        return self.status
+
+    def fetch_result(self, **kw):
+        self.status = self.status if self.status==True else self.check_status()
+        if self.status != True:
+            raise ValueError("local_handle.check_status() = {}. Status must be True if the results are ready.".format(self.status))
+        with open(self.path()) as f:
+            return f.read()
+
+def local_pool():
+    """The process pool local searches run on. It is created on first use so forked server workers each get their own."""
+    global LocalPool
+    if LocalPool is None:
+        LocalPool = ProcessPoolExecutor(LocalWorkers)
+    return LocalPool
+
+def local_search(query, database, path, hitlist_size=3000):
+    """
+    Search query against database and write BLAST XML to path. This is the job local_handle runs on the worker 
+    pool. The XML is written to a temporary file and renamed so it never appears half written. If the search fails
+    the error is written to path with the extension .err instead.
+
+    Parameters
+    ----------
+    query : str
+        A bare sequence or FASTA
+    database : str
+        A FASTA file, or a blast database name if blastp is installed
+    path : str
+        Where to write the XML
+    hitlist_size : int
+        Maximum number of hits per query
+    """
+    try:
+        if shutil.which('blastp') is not None:
+            queryfile = path + '.query'
+            with open(queryfile, 'w') as f:
+                f.write(query if query.lstrip().startswith('>') else '>Query_1\n' + query + '\n')
+            dbarg = ['-db', database] if os.path.exists(database + '.pin') or os.path.exists(database + '.pal') else ['-subject', database]
+            xml = subprocess.run(
+                ['blastp', '-query', queryfile, '-outfmt', '5', '-max_target_seqs', str(hitlist_size)] + dbarg,
+                stdout=subprocess.PIPE, check=True, universal_newlines=True,
+            ).stdout
+            os.remove(queryfile)
+        else:
+            if query.lstrip().startswith('>'):
+                queries = list(iter_fasta(query.splitlines()))
+            else:
+                queries = [('>Query_1', query)]
+            iterations = []
+            for header,seq in queries:
+                hits = []
+                with open(database) as f:
+                    records = iter_fasta(f)
+                    while True:
+                        chunk = [i for _,i in zip(range(LocalChunkSize), records)]
+                        if len(chunk) == 0:
+                            break
+                        alns = smith_waterman_kernel(seq, [i[1] for i in chunk])
+                        hits.extend((aln, record) for aln,record in zip(alns, chunk) if aln[4] > 0)
+                        hits = sorted(hits, key=lambda x: -x[0][4])[:hitlist_size]
+                iterations.append((header[1:], len(seq), [alignment_fields(aln, *record) for aln,record in hits]))
+            xml = format_blast_xml(iterations, database=database)
+        with open(path + '.tmp', 'w') as f:
+            f.write(xml)
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        with open(path[:-len('xml')] + 'err', 'w') as f:
+            f.write(repr(e))
+        raise
+
+def clean_local_results(lifetime, results_dir=None):
+    """
+    Remove the files of local searches last written more than lifetime seconds ago
+
+    Parameters
+    ----------
+    lifetime : float
+        Age in seconds after which a search's files are no longer needed
+    results_dir : str (optional)
+        Defaults to LocalResultsDir
+    Returns
+    -------
+    removed : int
+        The number of files removed
+    """
+    results_dir = LocalResultsDir if results_dir is None else results_dir
+    if not os.path.isdir(results_dir):
+        return 0
+    removed,cutoff = 0,time.time() - lifetime
+    for entry in os.scandir(results_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            #Another worker got there first
+            pass
+    return removed
 
 class blast_results():
     """
-    Turn the BLAST XML dump into a more useable object
+    Turn the BLAST XML dump into a more useable object. The hits are kept as a 2D uint8 array of ascii codes, 
+    blast_results.alignment, with one row per hit sorted by descending score and one column per query residue. 
+
+    Instance Variables
+    ------------------
+        blast_results.query (np.ndarray) the query residues, shape (query_length,)
+        blast_results.alignment (np.ndarray) the hit residues registered to the query, shape (hits, query_length)
+        blast_results.scores (np.ndarray) the score of each hit
+        blast_results.query_from, blast_results.query_to (np.ndarray) the one based query range of each hit
+        blast_results.uids (list) the accession of each hit
+        blast_results.definitions (list) the description of each hit
+        blast_results.substitutions (list) for each query position, an int used as a bitset of the hits (bit i is 
+            row i of blast_results.alignment) with an amino acid other than the query residue at that position
     """
-    def __init__(self, XML):
+    @metrics.timed(ParseSeconds, function='blast_results')
+    def __init__(self, XML, query=None, iteration=0):
+        """
+        Parameters
+        ----------
+        XML : str, bytes or file-like
+            The XML formatted BLAST results. The document is read once with a streaming parser, so file-like 
+            objects (e.g. an open file or a raw http response) need not be read into memory first.
+        query : str (optional)
+            The query sequence. If it is not supplied it is reconstructed from the query side of the alignments.
+        iteration : int (optional)
+            Which <Iteration> (query of a multi-query search) to read. Use split_iterations to read all of them.
+        """
+        hits = []
+        for i,query_length,fields in iterparse_hits(XML):
+            if i > iteration:
+                break
+            elif i == iteration:
+                hits.append((query_length, fields))
+        self.read_hits(hits, query)
+
+    def read_hits(self, hits, query=None):
         """
+        Fill in the arrays from parsed hits
+
         Parameters
         ----------
-        XML : str
-            The XML formatted BLAST results
+        hits : list
+            (query_length, fields) tuples as yielded by iterparse_hits for a single iteration
+        query : str (optional)
+            The query sequence
         """
-        self.soup = BeautifulSoup(XML, features='lxml')
-        query_length = int(self.soup.find("iteration_query-len").text)
-        self.hits = sorted([blast_hit(str(hit), query_length) for hit in self.soup.findAll('hit')], key = lambda x: -x.score)
-        self.uids = [i.accession for i in self.hits]
+        self.query_length = None
+        scores,ranges,segments,uids,definitions = [],[],[],[],[]
+        for query_length,fields in hits:
+            self.query_length = query_length
+            qseq = np.frombuffer(fields['qseq'].encode('ascii'), dtype=np.uint8)
+            hseq = np.frombuffer(fields['hseq'].encode('ascii'), dtype=np.uint8)
+            #Remove query sequence gaps from the alignment
+            segments.append((qseq[qseq != Gap], hseq[qseq != Gap]))
+            ranges.append((int(fields['query_from']), int(fields['query_to'])))
+            scores.append(float(fields['score']))
+            uids.append(fields['accession'])
+            definitions.append(fields['definition'])
+
+        if self.query_length is None:
+            self.query_length = len(query) if query is not None else max([i[1] for i in ranges], default=0)
+
+        #Sort by descending score. The sort is stable, so ties keep the order NCBI reported them in
+        order = np.argsort(-np.array(scores, dtype=float), kind='stable')
+        self.scores = np.array(scores, dtype=float)[order]
+        self.query_from,self.query_to = np.array(ranges, dtype=np.int32).reshape(-1, 2)[order].T
+        self.uids = [uids[i] for i in order]
+        self.definitions = [definitions[i] for i in order]
+
+        self.alignment = np.full((len(order), self.query_length), Gap, dtype=np.uint8)
+        for row,i in enumerate(order):
+            start = ranges[i][0] - 1
+            self.alignment[row, start:start + len(segments[i][1])] = segments[i][1][:self.query_length - start]
+
+        if query is not None:
+            query = np.frombuffer(query.upper().encode('ascii'), dtype=np.uint8)[:self.query_length]
+            self.query = np.full(self.query_length, Gap, dtype=np.uint8)
+            self.query[:len(query)] = query
+        else:
+            #Fill in the query from the best scoring hit covering each position
+            self.query = np.full(self.query_length, Gap, dtype=np.uint8)
+            for i in order:
+                start = ranges[i][0] - 1
+                segment = self.query[start:start + len(segments[i][0])]
+                missing = segment == Gap
+                segment[missing] = segments[i][0][:len(segment)][missing]
+
+        self.substitutions = substitution_index(self.alignment, self.query)
         #Add the aligned hit sequences to self.seqs
         self.seqs,self.headers = None, None
 
+    @property
+    def sequence(self):
+        """The query sequence as a string. Positions not covered by any hit are gaps unless the query was supplied"""
+        return self.query.tobytes().decode('ascii')
+
+    @property
+    def hits(self):
+        """A list of blast_hit objects for every row of blast_results.alignment. This is expensive for large results"""
+        return [self.hit(i) for i in range(len(self.uids))]
+
+    def hit(self, i):
+        """
+        Parameters
+        ----------
+        i : int
+            The row of blast_results.alignment, which is the rank of the hit by score
+        Returns
+        -------
+        hit : blast_hit
+        """
+        start,stop = self.query_from[i] - 1, self.query_to[i]
+        return blast_hit({
+            'accession'  : self.uids[i],
+            'definition' : self.definitions[i],
+            'score'      : self.scores[i],
+            'query_from' : self.query_from[i],
+            'query_to'   : self.query_to[i],
+            'qseq'       : self.query[start:stop].tobytes().decode('ascii'),
+            'hseq'       : self.alignment[i, start:stop].tobytes().decode('ascii'),
+            }, self.query_length)
+
+    def export(self, format='fasta', start=0, stop=None):
+        """
+        Write out the query registered alignment of the hits one record at a time
+
+        Parameters
+        ----------
+        format : str (optional)
+            'fasta' for aligned FASTA or 'aligned' for one line per sequence with the names in a column
+        start : int (optional)
+            The first hit to write. The query is written before hit 0.
+        stop : int (optional)
+            One past the last hit to write. Defaults to the last hit.
+        Yields
+        ------
+        text : str
+            The record of the query or of one hit, including its line breaks
+        """
+        if format not in ExportFormats:
+            raise ValueError("Unknown export format {}. Use one of {}".format(format, ExportFormats))
+        width = max([len(i) for i in self.uids] + [len('Query')]) + 2
+        if start == 0:
+            if format == 'fasta':
+                yield ">Query\n{}\n".format(self.sequence)
+            else:
+                yield "{}{}\n".format('Query'.ljust(width), self.sequence)
+        for i in range(start, len(self.uids) if stop is None else min(stop, len(self.uids))):
+            row = self.alignment[i].tobytes().decode('ascii')
+            if format == 'fasta':
+                yield ">{} {}\n{}\n".format(self.uids[i], self.definitions[i], row)
+            else:
+                yield "{}{}\n".format(self.uids[i].ljust(width), row)
+
+    @metrics.timed(RecommendSeconds)
     def recommend_mutant(self, residues):
         """
         Parameters
         ----------
         residues : iterable
             The residue numbers (type int) that you wish to mutate
+        Returns
+        -------
+        hit : blast_hit
+            The best scoring hit with an amino acid differing from the query at every residue or None
         """
-        for hit in self.hits:
-            if False not in [hit.qseq[i-1] != hit.hseq[i-1] and hit.hseq[i-1] in AminoAcids for i in residues]:
-                return hit
-        return None
+        hits = self.recommend_mutants(residues, 1)
+        return hits[0] if len(hits) > 0 else None
 
-    def fetch_full_sequences(self):
+    def recommend_mutants(self, residues, k=10):
+        """
+        Parameters
+        ----------
+        residues : iterable
+            The residue numbers (type int) that you wish to mutate
+        k : int (optional)
+            The maximum number of hits to return. Set k=None to return all of them.
+        Returns
+        -------
+        hits : list
+            Up to k blast_hit objects, best score first, with an amino acid differing from the query at every residue
+        """
+        if len(self.uids) == 0:
+            return []
+        candidates = (1 << len(self.uids)) - 1
+        for i in residues:
+            candidates &= self.substitutions[i-1]
+        hits = []
+        while candidates and (k is None or len(hits) < k):
+            #The lowest set bit is the best scoring remaining hit
+            lowest = candidates & -candidates
+            hits.append(self.hit(lowest.bit_length() - 1))
+            candidates ^= lowest
+        return hits
+
+    def profile(self, weighted=False):
+        """
+        Parameters
+        ----------
+        weighted : bool (optional)
+            Weight every hit by its score instead of counting each hit once
+        Returns
+        -------
+        counts, frequencies, entropy : np.ndarray
+            The conservation profile of the hits. See conservation_profile.
+        """
+        return conservation_profile(self.alignment, self.scores if weighted else None)
+
+    def fetch_full_sequences(self, cache=None):
         """
         blaster.fetch_full_sequences()
         If blaster.uids is not None, download the full sequence of every uid and store it in blaster.seqs
         You should probably not use this unless you're desperate. As a caution, sometimes blast hits contain
-        full genomes which might be awkard. 
-        
+        full genomes which might be awkard. Sequences are read from the local sequence_cache first and only
+        the missing ones are downloaded. Each batch of downloads is stored as it arrives, so an interrupted 
+        download is not repeated. blaster.headers and blaster.seqs line up with blaster.uids. Uids NCBI
+        did not return have a header of None and an empty sequence.
+
+        Parameters
+        ----------
+        cache : sequence_cache (optional)
+            Defaults to a sequence_cache at SequenceCachePath
         """
         if self.uids is not None:
-            fasta= efetch(self.uids) #flat text fasta format is the default for efetch
-            self.headers,self.seqs = zip(*(('>'+i.split('\n')[0], ''.join(i.split('\n')[1:])) for i in fasta.split('>')[1:]))
+            cache = sequence_cache() if cache is None else cache
+            found = cache.get(self.uids)
+            missing = [i for i in self.uids if accession_key(i) not in found]
+            records = []
+            for header,seq in efetch(missing): #flat text fasta format is the default for efetch
+                found[accession_key(header)] = (header, seq)
+                records.append((header, seq))
+                if len(records) >= EfetchBatchSize:
+                    cache.put(records)
+                    records = []
+            cache.put(records)
+            self.headers,self.seqs = zip(*[found.get(accession_key(i), (None, '')) for i in self.uids]) if len(self.uids) else ((), ())
+
+    def realign_full_sequences(self, executor=None, shard_size=64):
+        """
+        Align every full length sequence in blast_results.seqs to the query on a pool of processes. Results are 
+        yielded as each shard of sequences finishes, so they arrive out of order.
+
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor (optional)
+            The pool to run the alignments on. By default a ProcessPoolExecutor with one process per core is 
+            started for the duration of the call.
+        shard_size : int (optional)
+            The number of sequences aligned by each task
+        Yields
+        ------
+        i : int
+            The index of the sequence in blast_results.seqs
+        registered_seq : str
+            The sequence registered to the query residue by residue, in the same layout as blast_hit.hseq
+        """
+        if self.seqs is None:
+            self.fetch_full_sequences()
+        #Uncovered query positions are gaps unless the query was supplied. Align them as unknown residues.
+        query = self.sequence.replace('-', 'X')
+        pool = ProcessPoolExecutor() if executor is None else executor
+        futures = {}
+        try:
+            futures = {pool.submit(register_sequences, query, self.seqs[i:i+shard_size]) : i for i in range(0, len(self.seqs), shard_size)}
+            for future in as_completed(futures):
+                for i,registered_seq in enumerate(future.result(), futures[future]):
+                    yield i, registered_seq
+        finally:
+            #Stop any remaining work if the caller stops early
+            for future in futures:
+                future.cancel()
+            if executor is None:
+                pool.shutdown()
 
 class blast_hit():
     """
@@ -231,98 +820,748 @@ class blast_hit():
         """
         Parameters
         ----------
-        XML : str
-            The XML corresponding to a single blast hit
+        XML : str or dict
+            The XML corresponding to a single blast hit or the dictionary of fields yielded for it by 
+            iterparse_hits
         """
-        self.soup  = BeautifulSoup(XML, features='lxml')
-        self.score = float(self.soup.hsp_score.text)
-        self.accession = self.soup.hit_accession.text
+        fields = XML if isinstance(XML, dict) else next(iterparse_hits(XML))[2]
+        self.score = float(fields['score'])
+        self.accession = fields['accession']
+        self.definition = fields['definition']
 
-        qseq = self.soup.hsp_qseq.text
-        hseq = self.soup.hsp_hseq.text
+        qseq = fields['qseq']
+        hseq = fields['hseq']
         #Remove query sequence gaps from the alignment
         qseq,hseq = zip(*((i,j) for i,j in zip(qseq,hseq) if i!='-'))
         qseq,hseq = ''.join(qseq),''.join(hseq)
 
         #Number of gaps to pad the ends of the hit sequences
-        lpad = int(self.soup.find("hsp_query-from").text) - 1 
+        lpad = int(fields['query_from']) - 1 
 
         rpad = 0
         if query_length is not None:
-            rpad = query_length - int(self.soup.find("hsp_query-to").text)
+            rpad = query_length - int(fields['query_to'])
         
         self.qseq = '-'*lpad + qseq + '-'*rpad
         self.hseq = '-'*lpad + hseq + '-'*rpad
 
     def __str__(self):
-       text = "Accession: {}\n{}\n".format(self.accession, self.soup.hit_def.text)
+       text = "Accession: {}\n{}\n".format(self.accession, self.definition)
        text = text + format_alignment(self.qseq, self.hseq)
        return text
 
-def efetch(uids, **kw):
+def substitution_index(alignment, query):
+    """
+    Parameters
+    ----------
+    alignment : np.ndarray
+        The (hits, query_length) uint8 array of query registered hit residues
+    query : np.ndarray
+        The query residues
+    Returns
+    -------
+    index : list
+        For every query position, an int whose bit i is set if row i of the alignment carries an amino acid
+        other than the query residue at that position
+    """
+    mask = (alignment != query) & IsAminoAcid[alignment]
+    packed = np.packbits(mask.T, axis=1, bitorder='little')
+    return [int.from_bytes(i.tobytes(), 'little') for i in packed]
+
+def conservation_profile(alignment, weights=None):
+    """
+    Tally the residues observed at every query position in a single pass over the alignment
+
+    Parameters
+    ----------
+    alignment : np.ndarray
+        The (hits, query_length) uint8 array of query registered hit residues
+    weights : np.ndarray (optional)
+        The weight of each hit, for instance blast_results.scores. By default every hit counts once.
+    Returns
+    -------
+    counts : np.ndarray
+        (query_length, len(ProfileAlphabet)) float array of the (weighted) number of hits with each residue
+    frequencies : np.ndarray
+        (query_length, 20) float array of the amino acid frequencies at each position. Gaps and ambiguous 
+        residues are left out. Positions without amino acids are all zero.
+    entropy : np.ndarray
+        The Shannon entropy of the frequencies at each position in bits
+    """
+    hits,length = alignment.shape
+    width = len(ProfileAlphabet)
+    offsets = width*np.arange(length)
+    counts = np.zeros(length*width)
+    for i in range(0, hits, ProfileChunkSize):
+        chunk = alignment[i:i+ProfileChunkSize]
+        w = None if weights is None else np.repeat(np.asarray(weights, dtype=float)[i:i+ProfileChunkSize], length)
+        counts += np.bincount((ProfileIndex[chunk] + offsets).ravel(), weights=w, minlength=length*width)
+    counts = counts.reshape(length, width)
+
+    residues = counts[:,:20]
+    total = residues.sum(1, keepdims=True)
+    frequencies = np.divide(residues, total, out=np.zeros_like(residues), where=total > 0)
+    logs = np.log2(frequencies, out=np.zeros_like(frequencies), where=frequencies > 0)
+    entropy = 0. - (frequencies*logs).sum(1)
+    return counts, frequencies, entropy
+
+@metrics.timed(ParseSeconds, function='split_iterations')
+def split_iterations(XML, queries=None):
+    """
+    Read a multi-query BLAST XML document in a single pass
+
+    Parameters
+    ----------
+    XML : str, bytes or file-like
+        The XML formatted BLAST results
+    queries : list (optional)
+        The query sequence of each iteration
+    Returns
+    -------
+    results : list
+        One blast_results object per <Iteration>, or per query if more queries are given than iterations have hits
+    """
+    iterations = {}
+    for iteration,query_length,fields in iterparse_hits(XML):
+        iterations.setdefault(iteration, []).append((query_length, fields))
+    count = max(len(queries) if queries is not None else 0, max(iterations, default=-1) + 1)
+    results = []
+    for i in range(count):
+        result = blast_results.__new__(blast_results)
+        result.read_hits(iterations.get(i, []), queries[i] if queries is not None and i < len(queries) else None)
+        results.append(result)
+    return results
+
+#Map from BLAST XML tags to the blast_hit fields they populate
+HitTags = {
+    'Hit_accession'  : 'accession',
+    'Hit_def'        : 'definition',
+    'Hsp_score'      : 'score',
+    'Hsp_query-from' : 'query_from',
+    'Hsp_query-to'   : 'query_to',
+    'Hsp_qseq'       : 'qseq',
+    'Hsp_hseq'       : 'hseq',
+}
+
+def iterparse_hits(XML, chunk_size=2**16):
+    """
+    Stream the hits out of a BLAST XML document in a single pass. Each <Hit> element is dropped from the tree as 
+    soon as its fields have been read so memory use does not grow with the number of hits. Only the first HSP of 
+    each hit is considered. Anything trailing the closing tag of the root element is ignored.
+
+    Parameters
+    ----------
+    XML : str, bytes or file-like
+        The XML formatted BLAST results
+    chunk_size : int
+        Number of characters or bytes fed to the parser at a time
+
+    Yields
+    ------
+    iteration : int
+        Zero based index of the <Iteration> (query) containing this hit
+    query_length : int
+        The Iteration_query-len of the iteration containing this hit or None if it is absent
+    fields : dict
+        The text of the tags in HitTags keyed by their field names
+    """
+    if hasattr(XML, 'read'):
+        chunks = iter(lambda: XML.read(chunk_size), XML.read(0))
+    else:
+        chunks = (XML[i:i+chunk_size] for i in range(0, len(XML), chunk_size))
+
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    stack,fields,hsps = [],None,0
+    iteration,query_length = 0,None
+    for chunk in chunks:
+        parser.feed(chunk)
+        #A document which is not XML raises ParseError here. Reading stops at the end of the root element, before
+        #the parser can complain about anything trailing it.
+        for event,elem in parser.read_events():
+            if event == 'start':
+                stack.append(elem)
+                if elem.tag == 'Hit':
+                    fields,hsps = {},0
+                elif elem.tag == 'Hsp':
+                    hsps += 1
+                continue
+
+            stack.pop()
+            if elem.tag == 'Hit':
+                yield iteration, query_length, fields
+                fields = None
+            elif fields is not None:
+                if elem.tag in HitTags and hsps <= 1:
+                    fields[HitTags[elem.tag]] = elem.text or ''
+                continue #Hit children are dropped along with the hit
+            elif elem.tag == 'Iteration_query-len':
+                query_length = int(elem.text)
+            elif elem.tag == 'Iteration':
+                iteration,query_length = iteration + 1,None
+
+            if len(stack) == 0:
+                return
+            stack[-1].remove(elem)
+    parser.close()
+
+def alignment_fields(aln, header, seq):
+    """
+    Parameters
+    ----------
+    aln : tuple
+        An alignment from smith_waterman_kernel
+    header : str
+        The FASTA header of the aligned database sequence
+    seq : str
+        The aligned database sequence
+    Returns
+    -------
+    fields : dict
+        The alignment described with the fields of iterparse_hits, plus hit_from and hit_to, for format_blast_xml
+    """
+    aln1,aln2,start1,start2,score = aln
+    return {
+        'accession'  : accession_key(header),
+        'definition' : ' '.join(header[1:].split()[1:]),
+        'score'      : score,
+        'query_from' : start1 + 1,
+        'query_to'   : start1 + len(aln1.replace('-', '')),
+        'hit_from'   : start2 + 1,
+        'hit_to'     : start2 + len(aln2.replace('-', '')),
+        'hit_len'    : len(seq),
+        'qseq'       : aln1,
+        'hseq'       : aln2,
+    }
+
+def format_blast_xml(iterations, program='blastp', database=''):
+    """
+    Write BLAST XML in the layout NCBI returns for FORMAT_TYPE=XML. Only the fields REP-X reads are guaranteed
+    to be meaningful.
+
+    Parameters
+    ----------
+    iterations : iterable
+        One (query_def, query_length, hits) tuple per query where hits is an iterable of dicts with the keys 
+        produced by iterparse_hits. hit_from, hit_to and hit_len are used if they are present.
+    program : str (optional)
+    database : str (optional)
+    Returns
+    -------
+    XML : str
+    """
+    out = io.StringIO()
+    out.write('<?xml version="1.0"?>\n<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">\n')
+    out.write('<BlastOutput>\n  <BlastOutput_program>{}</BlastOutput_program>\n  <BlastOutput_db>{}</BlastOutput_db>\n'.format(program, escape(database)))
+    out.write('  <BlastOutput_iterations>\n')
+    for num,(query_def,query_length,hits) in enumerate(iterations, 1):
+        out.write('    <Iteration>\n      <Iteration_iter-num>{0}</Iteration_iter-num>\n      <Iteration_query-ID>Query_{0}</Iteration_query-ID>\n'.format(num))
+        out.write('      <Iteration_query-def>{}</Iteration_query-def>\n      <Iteration_query-len>{}</Iteration_query-len>\n'.format(escape(query_def), query_length))
+        out.write('      <Iteration_hits>\n')
+        for i,hit in enumerate(hits, 1):
+            pairs = [(a,b) for a,b in zip(hit['qseq'], hit['hseq'])]
+            identity = sum([a==b and a!='-' for a,b in pairs])
+            gaps = sum([a=='-' or b=='-' for a,b in pairs])
+            midline = ''.join([a if a==b else ' ' for a,b in pairs])
+            out.write(HitTemplate.format(
+                num = i,
+                accession = escape(hit['accession']),
+                definition = escape(hit['definition']),
+                hit_len = hit.get('hit_len', len(hit['hseq'].replace('-', ''))),
+                score = hit['score'],
+                query_from = hit['query_from'],
+                query_to = hit['query_to'],
+                hit_from = hit.get('hit_from', 1),
+                hit_to = hit.get('hit_to', len(hit['hseq'].replace('-', ''))),
+                identity = identity,
+                gaps = gaps,
+                align_len = len(pairs),
+                qseq = hit['qseq'],
+                hseq = hit['hseq'],
+                midline = midline,
+            ))
+        out.write('      </Iteration_hits>\n    </Iteration>\n')
+    out.write('  </BlastOutput_iterations>\n</BlastOutput>\n')
+    return out.getvalue()
+
+HitTemplate = """        <Hit>
+          <Hit_num>{num}</Hit_num>
+          <Hit_id>{accession}</Hit_id>
+          <Hit_def>{definition}</Hit_def>
+          <Hit_accession>{accession}</Hit_accession>
+          <Hit_len>{hit_len}</Hit_len>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_score>{score:g}</Hsp_score>
+              <Hsp_query-from>{query_from}</Hsp_query-from>
+              <Hsp_query-to>{query_to}</Hsp_query-to>
+              <Hsp_hit-from>{hit_from}</Hsp_hit-from>
+              <Hsp_hit-to>{hit_to}</Hsp_hit-to>
+              <Hsp_identity>{identity}</Hsp_identity>
+              <Hsp_gaps>{gaps}</Hsp_gaps>
+              <Hsp_align-len>{align_len}</Hsp_align-len>
+              <Hsp_qseq>{qseq}</Hsp_qseq>
+              <Hsp_hseq>{hseq}</Hsp_hseq>
+              <Hsp_midline>{midline}</Hsp_midline>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+"""
+
+#Header identifying the binary format written by dumps
+PackMagic   = b'REPX'
+PackVersion = 1
+
+def dumps(results):
+    """
+    Serialize a blast_results object to a compact, compressed and versioned binary string. This is what gets
+    cached in redis so that finished results never need to be parsed from XML again.
+
+    Parameters
+    ----------
+    results : blast_results
+    Returns
+    -------
+    data : bytes
+    """
+    buffer = io.BytesIO()
+    buffer.write(PackMagic + struct.pack('>H', PackVersion))
+    np.savez_compressed(
+        buffer,
+        query       = results.query,
+        alignment   = results.alignment,
+        scores      = results.scores,
+        query_from  = results.query_from,
+        query_to    = results.query_to,
+        uids        = np.frombuffer('\n'.join(results.uids).encode('utf-8'), dtype=np.uint8),
+        definitions = np.frombuffer('\n'.join(results.definitions).encode('utf-8'), dtype=np.uint8),
+    )
+    return buffer.getvalue()
+
+def is_packed(data):
+    """is_packed(bytes): was data written by blast.dumps"""
+    return data[:len(PackMagic)] == PackMagic
+
+def loads(data):
+    """
+    Reconstruct a blast_results object written by dumps
+
+    Parameters
+    ----------
+    data : bytes
+    Returns
+    -------
+    results : blast_results
+    """
+    if not is_packed(data):
+        raise ValueError("blast.loads got data which was not written by blast.dumps")
+    version, = struct.unpack('>H', data[len(PackMagic):len(PackMagic) + 2])
+    if version != PackVersion:
+        raise ValueError("blast.loads got version {} data. Only version {} is supported".format(version, PackVersion))
+
+    arrays = np.load(io.BytesIO(data[len(PackMagic) + 2:]), allow_pickle=False)
+    results = blast_results.__new__(blast_results)
+    results.query       = arrays['query']
+    results.alignment   = arrays['alignment']
+    results.scores      = arrays['scores']
+    results.query_from  = arrays['query_from']
+    results.query_to    = arrays['query_to']
+    results.uids        = arrays['uids'].tobytes().decode('utf-8').split('\n') if len(results.scores) else []
+    results.definitions = arrays['definitions'].tobytes().decode('utf-8').split('\n') if len(results.scores) else []
+    results.query_length = len(results.query)
+    results.substitutions = substitution_index(results.alignment, results.query)
+    results.seqs,results.headers = None, None
+    return results
+
+def efetch(uids, batch_size=EfetchBatchSize, workers=EfetchWorkers, **kw):
+    """
+    Download sequences from NCBI entrez. The uids are split into batches which are requested concurrently while 
+    keeping under NCBI's limit of EfetchRate requests per second, shared by every efetch call in the process. 
+    Each response is parsed as it streams in.
+
+    Parameters
+    ----------
+    uids : iterable
+        Accessions or GIs to download
+    batch_size : int (optional)
+        Maximum number of uids per request
+    workers : int (optional)
+        Maximum number of requests in flight
+    **kwargs : optional
+        Extra efetch parameters. The defaults are db='protein', rettype='fasta' and retmode='text'.
+    Yields
+    ------
+    header : str
+        The FASTA header line including the leading '>'
+    seq : str
+        The sequence
+    """
     kw['db'] = kw.get('db', 'protein')
     kw['rettype'] = kw.get('rettype', 'fasta')
     kw['retmode'] = kw.get('retmode', 'text')
-    kw['id'] = ','.join(uids)
-    BaseURL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-    r = requests.post(BaseURL, data=kw)
-    return r.text
+    uids = list(uids)
+
+    def fetch(batch):
+        EfetchLimiter.wait()
+        with EfetchSeconds.time():
+            r = requests.post(EfetchURL, data=dict(kw, id=','.join(batch)), stream=True)
+            r.raise_for_status()
+            return list(iter_fasta(r.iter_lines(decode_unicode=True)))
+
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(fetch, uids[i:i+batch_size]) for i in range(0, len(uids), batch_size)]
+        for future in as_completed(futures):
+            for record in future.result():
+                yield record
+
+def iter_fasta(lines):
+    """
+    Parameters
+    ----------
+    lines : iterable
+        Lines of FASTA formatted text, e.g. an open file
+    Yields
+    ------
+    header : str
+        The header line including the leading '>'
+    seq : str
+        The sequence with all whitespace removed
+    """
+    header,seq = None,[]
+    for line in lines:
+        line = line.strip()
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(seq)
+            header,seq = line,[]
+        elif header is not None and len(line) > 0:
+            seq.append(line)
+    if header is not None:
+        yield header, ''.join(seq)
+
+class rate_limiter():
+    """
+    Space out calls to rate_limiter.wait() from any number of threads so that at most rate happen per second
+    """
+    def __init__(self, rate):
+        self.interval = 1./rate
+        self.next = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(self.next - now, 0.)
+            self.next = max(self.next, now) + self.interval
+        time.sleep(delay)
+
+#NCBI's limit is per client, so every efetch call waits on the same limiter
+EfetchLimiter = rate_limiter(EfetchRate)
+
+def accession_key(uid):
+    """accession_key(str): the accession in a FASTA header or uid without the leading '>' or its version number"""
+    return uid.lstrip('>').split()[0].split('.')[0]
+
+class sequence_cache():
+    """
+    A persistent accession -> sequence store in an SQLite database so sequences are only ever downloaded once.
+    Accessions are stored without their version number (see accession_key).
+    """
+    def __init__(self, path=SequenceCachePath):
+        """
+        Parameters
+        ----------
+        path : str (optional)
+            The SQLite database file. It is created if it does not exist.
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sequences (accession TEXT PRIMARY KEY, header TEXT, seq TEXT)")
+        self.db.commit()
+
+    def get(self, uids):
+        """
+        Parameters
+        ----------
+        uids : iterable
+            Accessions to look up
+        Returns
+        -------
+        found : dict
+            (header, seq) tuples keyed by the accession_key of every uid present in the cache
+        """
+        keys = list(set(accession_key(i) for i in uids))
+        found = {}
+        #Stay under SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            query = "SELECT accession, header, seq FROM sequences WHERE accession IN ({})".format(','.join('?'*len(batch)))
+            for accession,header,seq in self.db.execute(query, batch):
+                found[accession] = (header, seq)
+        return found
+
+    def put(self, records):
+        """
+        Parameters
+        ----------
+        records : iterable
+            (header, seq) tuples as yielded by efetch or iter_fasta
+        """
+        self.db.executemany(
+            "INSERT OR REPLACE INTO sequences (accession, header, seq) VALUES (?, ?, ?)", 
+            ((accession_key(header), header, seq) for header,seq in records)
+        )
+        self.db.commit()
+
+#The BLOSUM62 substitution matrix
+Blosum62 = """
+   A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+* -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+"""
+Blosum62Alphabet = Blosum62.split('\n')[1].split()
+Blosum62Matrix = np.array([i.split()[1:] for i in Blosum62.strip().split('\n')[1:]], dtype=float)
+#Lookup table from ascii codes to rows of Blosum62Matrix. Anything unrecognized scores as X
+Blosum62Index = np.full(256, Blosum62Alphabet.index('X'), dtype=np.intp)
+for i,aa in enumerate(Blosum62Alphabet):
+    Blosum62Index[ord(aa)] = Blosum62Index[ord(aa.lower())] = i
 
 class smith_waterman():
     """
-    align two sequences using the smith-waterman algorithm via water of the EMBOSS suite
+    align two sequences using the smith-waterman algorithm with the BLOSUM62 matrix and affine gap penalties. The 
+    defaults and the identity and similarity statistics follow water of the EMBOSS suite.
 
     Parameters
     ----------
         seq1: an amino acid sequence to be aligned with seq2
         seq2: an amino acid sequence
+        gapopen: float, default=10. the penalty for the first residue of a gap
+        gapextend: float, default=0.5 the penalty for each further residue of a gap
     Class Methods
     -------------
-        smith_waterman.align(): make an external call to the emboss suite and align seq1&2 supplied at __init__
+        smith_waterman.align(): align seq1&2 supplied at __init__
 
     Instance Variables
     ------------------
-        smith_waterman.aln str is where we keep the text output from water
+        smith_waterman.aln tuple is where we keep the aligned (gapped) segments of seq1 and seq2
+        smith_waterman.start1 (int) is the zero based position in seq1 where the alignment starts
+        smith_waterman.start2 (int) is the zero based position in seq2 where the alignment starts
+        smith_waterman.score (float) is the alignment score
         smith_waterman.seq1 is the first sequence provided at instantiation
         smith_waterman.seq2 is the second sequence provided at instantiation
-        smith_waterman.indentity  (float) is the sequence identity calculated by water
-        smith_waterman.similarity (float) is the sequence similarity calculated by water
+        smith_waterman.indentity  (float) is the percent sequence identity over the length of the alignment
+        smith_waterman.similarity (float) is the percent of aligned pairs with positive BLOSUM62 scores
         smith_waterman.registered_seq2 is the second sequence with the appropriate gap structure such that it has a
             1-1 correspondence with seq1, residue by residue. this may include a series of gaps at the n and/or c-terminus.
     """
     def __init__(self, seq1, seq2, **kw):
         self.header1,self.header2 = kw.get('h1', ''),kw.get('h2','')
         self.seq1,self.seq2 = seq1,seq2
+        self.gapopen,self.gapextend = kw.get('gapopen', 10.),kw.get('gapextend', 0.5)
         self.aln,self.identity,self.similarity = None,None,None
         self.registered_seq2 = None
-        self.align()
+        if kw.get('aln') is None:
+            self.align()
+        else:
+            self.register(*kw['aln'])
 
+    @metrics.timed(AlignSeconds)
     def align(self):
-        self.aln = subprocess.Popen(
-                ["/bin/bash",
-                    "-cs", 
-                    "water <(echo %s) <(echo %s) stdout -gapopen=10 -gapextend=0.5 2>/dev/null" %(self.seq1, self.seq2)
-                    ],
-                stdout=subprocess.PIPE
-            ).communicate()[0]
-        self.similarity = float(re.findall(r'Similarity:.*\n', self.aln)[0].split()[-1].strip('%()'))
-        self.identity   = float(re.findall(r'Identity:.*\n', self.aln)[0].split()[-1].strip('%()'))
-
-        #This whole block just registers the second seq with the first so we can examine the snps later
-        lines = (i for i in self.aln.split('\n') if len(i)>0 and i[0]!='#')
-        S = ""
-        for line1 in lines:
-            lines.next()#The middle line in each group of three has no amino acids
-            line2 = lines.next()
-            if len(S) == 0:
-                S = '-'*(int(line1.split()[0]) - 1) #Padding for the nterm of seq1
-            s1,s2 = line1.split()[1],line2.split()[1]
-            for aa1,aa2 in zip(s1,s2):
-                if aa1 != '-':
-                    S = S + aa2
+        self.register(*smith_waterman_kernel(self.seq1, [self.seq2], self.gapopen, self.gapextend)[0])
+
+    def register(self, aln1, aln2, start1, start2, score):
+        """
+        Compute the alignment statistics and registered_seq2 from the output of smith_waterman_kernel
+        """
+        self.aln = (aln1, aln2)
+        self.start1,self.start2,self.score = start1,start2,score
+
+        pairs = [(i,j) for i,j in zip(aln1, aln2) if i!='-' and j!='-']
+        identical = sum([i.upper()==j.upper() for i,j in pairs])
+        similar = sum([Blosum62Matrix[Blosum62Index[ord(i)], Blosum62Index[ord(j)]] > 0 for i,j in pairs])
+        self.identity   = round(100.*identical/len(aln1), 1) if len(aln1) > 0 else 0.
+        self.similarity = round(100.*similar/len(aln1), 1) if len(aln1) > 0 else 0.
+
+        #This registers the second seq with the first so we can examine the snps later
+        S = '-'*start1 + ''.join([aa2 for aa1,aa2 in zip(aln1, aln2) if aa1 != '-'])
         S = S.ljust(len(self.seq1), '-')
         self.registered_seq2 = S
 
+def align_many(seq1, seqs, **kw):
+    """
+    Align seq1 against every sequence in seqs in one batched call
+
+    Parameters
+    ----------
+    seq1 : str
+        The query sequence
+    seqs : iterable
+        The target sequences
+    **kwargs : optional
+        Passed on to smith_waterman, e.g. gapopen and gapextend
+    Returns
+    -------
+    alignments : list
+        A smith_waterman object for each target
+    """
+    seqs = list(seqs)
+    alns = smith_waterman_kernel(seq1, seqs, kw.get('gapopen', 10.), kw.get('gapextend', 0.5))
+    return [smith_waterman(seq1, seq2, aln=aln, **kw) for seq2,aln in zip(seqs, alns)]
+
+def register_sequences(seq1, seqs, **kw):
+    """
+    Parameters
+    ----------
+    seq1 : str
+        The query sequence
+    seqs : iterable
+        The target sequences
+    **kwargs : optional
+        Passed on to smith_waterman, e.g. gapopen and gapextend
+    Returns
+    -------
+    registered : list
+        The registered_seq2 of the alignment of seq1 to each target. This is the unit of work behind 
+        blast_results.realign_full_sequences and is picklable so it can run in a process pool.
+    """
+    return [i.registered_seq2 for i in align_many(seq1, seqs, **kw)]
+
+def smith_waterman_kernel(seq1, seqs, gapopen=10., gapextend=0.5, max_cells=2**25):
+    """
+    Vectorized local alignment of seq1 against many sequences. The dynamic programming matrix is filled one residue 
+    of seq1 at a time for every target and every target position at once. Gaps along the targets are resolved 
+    with a running maximum, so each row is a handful of numpy operations. Targets are processed in batches of 
+    similar length holding at most max_cells traceback cells. A target too long to fit in max_cells on its own is 
+    not aligned and gets the empty alignment, as if nothing in it aligned.
+
+    Parameters
+    ----------
+    seq1 : str
+        The query sequence
+    seqs : list
+        The target sequences
+    gapopen : float
+        The penalty for the first residue of a gap
+    gapextend : float
+        The penalty for each further residue of a gap
+    max_cells : int
+        The maximum number of traceback cells (bytes) held at once
+    Returns
+    -------
+    alignments : list
+        For each target a tuple of (aligned seq1, aligned seq2, start1, start2, score)
+    """
+    query = Blosum62Index[np.frombuffer(seq1.encode('ascii'), dtype=np.uint8)]
+    alignments = [None]*len(seqs)
+    order = sorted(range(len(seqs)), key=lambda i: len(seqs[i]))
+    batch = []
+    for i in order:
+        if len(seqs[i]) * len(query) > max_cells:
+            print("Not aligning a target of {} residues to a query of {}, more than max_cells={}".format(len(seqs[i]), len(query), max_cells))
+            alignments[i] = ('', '', 0, 0, 0.)
+            continue
+        if len(batch) > 0 and (len(batch) + 1) * max(len(seqs[i]), 1) * max(len(query), 1) > max_cells:
+            for j,aln in zip(batch, smith_waterman_batch(seq1, query, [seqs[j] for j in batch], gapopen, gapextend)):
+                alignments[j] = aln
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        for j,aln in zip(batch, smith_waterman_batch(seq1, query, [seqs[j] for j in batch], gapopen, gapextend)):
+            alignments[j] = aln
+    return alignments
+
+def smith_waterman_batch(seq1, query, seqs, gapopen, gapextend):
+    """
+    Align seq1 (with Blosum62Matrix indices query) against every sequence in seqs. See smith_waterman_kernel.
+    """
+    lengths = np.array([len(i) for i in seqs])
+    width = max(lengths.max(), 1)
+    targets = np.full((len(seqs), width), Blosum62Alphabet.index('*'), dtype=np.intp)
+    for i,seq in enumerate(seqs):
+        targets[i,:len(seq)] = Blosum62Index[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+    valid = np.arange(width) < lengths[:,None]
+    columns = np.arange(width + 1)
+
+    #Traceback bits: 0-1 the source of H (0 stop, 1 diagonal, 2 E, 3 F), 2 E extends, 3 F extends
+    trace = np.zeros((len(query), len(seqs), width), dtype=np.uint8)
+    H = np.zeros((len(seqs), width + 1))
+    E = np.full((len(seqs), width), -np.inf)
+    best = np.zeros(len(seqs))
+    best_i,best_j = np.zeros(len(seqs), dtype=int),np.zeros(len(seqs), dtype=int)
+    for i,aa in enumerate(query):
+        #E: gaps in the target (seq1 residue i against a gap)
+        diag = H[:,:-1] + Blosum62Matrix[aa][targets]
+        E_open,E_extend = H[:,1:] - gapopen, E - gapextend
+        E = np.maximum(E_open, E_extend)
+        Hp = np.maximum(np.maximum(diag, E), 0.)
+
+        #F: gaps in seq1. F[j] = max over k<j of H[k] - gapopen - (j-1-k)*gapextend, which is a running maximum
+        G = np.concatenate((np.zeros((len(seqs), 1)), Hp), axis=1) + gapextend*columns
+        F = np.maximum.accumulate(G, axis=1)[:,:-1] - gapopen - gapextend*columns[:-1]
+        row = np.maximum(Hp, F)
+
+        H_left = np.concatenate((np.zeros((len(seqs), 1)), row[:,:-1]), axis=1)
+        F_left = np.concatenate((np.full((len(seqs), 1), -np.inf), F[:,:-1]), axis=1)
+        trace[i] = np.where(row == 0, 0, np.where(row == diag, 1, np.where(row == E, 2, 3)))
+        trace[i] |= (E_extend > E_open).astype(np.uint8) << 2
+        trace[i] |= (F_left - gapextend > H_left - gapopen).astype(np.uint8) << 3
+
+        masked = np.where(valid, row, -1.)
+        j = masked.argmax(axis=1)
+        better = masked[np.arange(len(seqs)), j] > best
+        best[better],best_i[better],best_j[better] = masked[better, j[better]],i,j[better]
+        H[:,1:] = row
+
+    alignments = []
+    for b,seq2 in enumerate(seqs):
+        aln1,aln2 = [],[]
+        i,j,state = best_i[b],best_j[b],0
+        if best[b] <= 0:
+            alignments.append(('', '', 0, 0, 0.))
+            continue
+        while i >= 0 and j >= 0:
+            code = trace[i,b,j]
+            if state == 0:
+                state = code & 3
+                if state == 0:
+                    break
+                elif state == 1:
+                    aln1.append(seq1[i])
+                    aln2.append(seq2[j])
+                    i,j,state = i-1,j-1,0
+            elif state == 2:
+                aln1.append(seq1[i])
+                aln2.append('-')
+                i,state = i-1,(2 if code & 4 else 0)
+            else:
+                aln1.append('-')
+                aln2.append(seq2[j])
+                j,state = j-1,(3 if code & 8 else 0)
+        alignments.append((''.join(aln1[::-1]), ''.join(aln2[::-1]), i+1, j+1, best[b]))
+    return alignments
+
 def format_alignment(seq1, seq2, width=50):
     """
     Parameters
@@ -338,22 +1577,22 @@ def format_alignment(seq1, seq2, width=50):
     text : str
         The multiline formatted alignment text
     """
-    text = ''
-    l1,l2,l3 = '','',''
+    return ''.join(iter_alignment(seq1, seq2, width))
 
-    for i,(res1,res2) in enumerate(zip(seq1, seq2), 1):
-        l1 += res1
-        l3 += res2
-        if res1 == res2:
-            l2 += "|"
-        else:
-            l2 += ":"
-        if i%width == 0 or i==len(seq1):
-            l1 += " {}\n".format(i)
-            l2 += "\n"
-            l3 += " {}\n\n".format(i)
-            text += l1 + l2 + l3
-            l1, l2, l3 = '','',''
-
-    return text
+def iter_alignment(seq1, seq2, width=50):
+    """
+    Write the alignment of seq1 and seq2 a block of width residues at a time. Each block is the seq1 line, a line 
+    of "|" where the residues match and ":" where they differ, and the seq2 line. See format_alignment.
+
+    Yields
+    ------
+    text : str
+        One block of the alignment with its trailing blank line
+    """
+    length = min(len(seq1), len(seq2))
+    for start in range(0, length, width):
+        stop = min(start + width, length)
+        l1,l3 = seq1[start:stop],seq2[start:stop]
+        l2 = ''.join(["|" if res1 == res2 else ":" for res1,res2 in zip(l1, l3)])
+        yield "{0} {3}\n{1}\n{2} {3}\n\n".format(l1, l2, l3, stop)
 
@@ -0,0 +1,218 @@
+###############################################################################
+#                                                                             #
+# Counters and timers for REP-X exposed in the Prometheus text format.        #
+#                                                                             #
+###############################################################################
+
+import json,time,inspect,functools,threading,contextlib
+
+#Upper bounds in seconds of the histogram buckets timers sort durations into
+Buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., float('inf'))
+
+Registry = {} #Every metric by name in the order they were created
+
+class metric():
+    """
+    The base of counter, timer and gauge. A metric has one series of values per distinct set of labels and
+    registers itself by name so exposition can list it.
+    """
+    kind = None
+    per_process = True #Each process has its own values, which exposition labels by process when given several
+
+    def __init__(self, name, help):
+        if name in Registry:
+            raise ValueError("A metric named {} already exists".format(name))
+        self.name = name
+        self.help = help
+        self.series = {}
+        self.lock = threading.Lock()
+        Registry[name] = self
+
+    def state(self):
+        """A copy of every series as a dictionary from sorted label tuples to tuples of numbers"""
+        with self.lock:
+            return {k : tuple(v) for k,v in self.series.items()}
+
+    def add(self, labels, values):
+        """Add the tuple of numbers values to the series labels. This is how changes made elsewhere are merged."""
+        with self.lock:
+            series = self.series.setdefault(labels, [0]*len(values))
+            for i,v in enumerate(values):
+                series[i] += v
+
+    def samples(self, state):
+        """Yield the (suffix, labels, value) of every line this metric exposes given a state as returned by metric.state"""
+        raise NotImplementedError()
+
+class counter(metric):
+    """A count that only goes up, such as the number of redis commands sent"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.add(tuple(sorted(labels.items())), (amount,))
+
+    def samples(self, state):
+        for labels,(value,) in state.items():
+            yield '', labels, value
+
+class timer(metric):
+    """
+    A histogram of durations in seconds. Record them with timer.observe, the timer.time context manager or the
+    timed decorator.
+    """
+    kind = 'histogram'
+
+    def observe(self, seconds, **labels):
+        values = [1 if seconds <= bound else 0 for bound in Buckets]
+        self.add(tuple(sorted(labels.items())), values + [seconds, 1])
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, state):
+        for labels,values in state.items():
+            for bound,count in zip(Buckets, values):
+                yield '_bucket', labels + (('le', '+Inf' if bound == float('inf') else repr(bound)),), count
+            yield '_sum', labels, values[-2]
+            yield '_count', labels, values[-1]
+
+class gauge(metric):
+    """
+    A value that is read when the metrics are exposed, such as the length of a queue
+
+    Parameters
+    ----------
+    name : str
+    help : str
+    fn : function
+        Called without arguments at exposition. Returns a number or a dictionary from label dictionaries, as
+        tuples of (name, value) pairs, to numbers.
+    """
+    kind = 'gauge'
+    per_process = False
+
+    def __init__(self, name, help, fn):
+        metric.__init__(self, name, help)
+        self.fn = fn
+
+    def state(self):
+        #Gauges are read live, there is nothing to merge
+        return {}
+
+    def samples(self, state):
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {() : value}
+        for labels,v in value.items():
+            yield '', labels, v
+
+def timed(metric, **labels):
+    """
+    Decorator recording the duration of every call of a function or coroutine function in the timer metric
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            async def wrapper(*args, **kw):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kw)
+                finally:
+                    metric.observe(time.perf_counter() - start, **labels)
+        else:
+            def wrapper(*args, **kw):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kw)
+                finally:
+                    metric.observe(time.perf_counter() - start, **labels)
+        return functools.wraps(fn)(wrapper)
+    return decorator
+
+def snapshot():
+    """snapshot(): the state of every metric by name"""
+    return {name : m.state() for name,m in list(Registry.items())}
+
+def collect(fn, *args):
+    """
+    Call fn(*args) and return its value along with the changes it made to the metrics. Work sent to another
+    process runs through collect so that its metrics can be merged back into this process's with merge.
+
+    Returns
+    -------
+    value : object
+        The value of fn(*args)
+    changes : dict
+        The increase of every series that changed, by metric name and labels
+    """
+    before = snapshot()
+    try:
+        value = fn(*args)
+    except Exception as e:
+        #The changes travel home with the exception
+        e.metrics = changes_since(before)
+        raise
+    return value, changes_since(before)
+
+def changes_since(before):
+    """changes_since(dict): the increase of every series since the snapshot before"""
+    changes = {}
+    for name,state in snapshot().items():
+        old = before.get(name, {})
+        for labels,values in state.items():
+            delta = tuple(v - o for v,o in zip(values, old.get(labels, (0,)*len(values))))
+            if any(delta):
+                changes.setdefault(name, {})[labels] = delta
+    return changes
+
+def merge(changes):
+    """merge(dict): add the changes returned by collect to this process's metrics"""
+    for name,series in changes.items():
+        if name in Registry:
+            for labels,values in series.items():
+                Registry[name].add(labels, values)
+
+def encode(state):
+    """encode(dict): a snapshot as JSON, so that other processes can expose it"""
+    return json.dumps({name : [[labels, values] for labels,values in series.items()] for name,series in state.items()})
+
+def decode(text):
+    """decode(str): the snapshot encoded in text by encode"""
+    return {name : {tuple(tuple(i) for i in labels) : tuple(values) for labels,values in series} for name,series in json.loads(text).items()}
+
+def escape(value):
+    """escape(object): a label value quoted for the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def exposition(states=None):
+    """
+    Parameters
+    ----------
+    states : dict (optional)
+        Snapshots of several processes keyed by the labels that tell them apart, such as 
+        {(('worker', 0),) : snapshot}. Defaults to the snapshot of this process without extra labels. Gauges are
+        read once, in this process.
+    Returns
+    -------
+    text : str
+        Every metric in the Prometheus text exposition format, version 0.0.4
+    """
+    if states is None:
+        states = {() : snapshot()}
+    lines = []
+    for name,m in list(Registry.items()):
+        lines.append("# HELP {} {}".format(name, m.help.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append("# TYPE {} {}".format(name, m.kind))
+        for extra,state in (states.items() if m.per_process else [((), {})]):
+            for suffix,labels,value in m.samples(state.get(name, {})):
+                labels = extra + labels
+                if len(labels) > 0:
+                    labels = '{' + ','.join(['{}="{}"'.format(k, escape(v)) for k,v in labels]) + '}'
+                else:
+                    labels = ''
+                lines.append("{}{}{} {}".format(name, suffix, labels, repr(float(value)) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
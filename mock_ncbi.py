@@ -0,0 +1,102 @@
+###############################################################################
+#                                                                             #
+# A stand-in for the NCBI BLAST url api for running REP-X offline.            #
+#                                                                             #
+###############################################################################
+
+import sys
+from time import time
+from xml.etree import ElementTree
+from uuid import uuid4
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler, Application
+
+PutResponse = """<html>
+<!--QBlastInfoBegin
+    RID = {}
+    RTOE = {}
+QBlastInfoEnd
+-->
+</html>
+"""
+
+SearchInfoResponse = """<html>
+<!--
+QBlastInfoBegin
+\tStatus={}
+QBlastInfoEnd
+-->
+</html>
+"""
+
+class BlastCGIHandler(RequestHandler):
+    """
+    Mimics the CMD=Put, CMD=Get and CMD=Delete requests of Blast.cgi. Searches become READY waittime seconds after
+    they are submitted and every search returns the same XML document, cut to the first ALIGNMENTS hits of each
+    query if that argument is given.
+    """
+    def initialize(self, **kw):
+        self.searches = kw['SEARCHES']
+        self.xml = kw['XML']
+        self.waittime = kw.get('WAITTIME', 0)
+
+    def get(self):
+        cmd = self.get_argument('CMD')
+        if cmd == 'Put':
+            rid = uuid4().hex[:11].upper()
+            self.searches[rid] = time() + self.waittime
+            self.write(PutResponse.format(rid, self.waittime))
+        elif cmd == 'Get':
+            rid = self.get_argument('RID')
+            if rid not in self.searches:
+                status = 'UNKNOWN'
+            elif time() < self.searches[rid]:
+                status = 'WAITING'
+            else:
+                status = 'READY'
+            if self.get_argument('FORMAT_OBJECT', None) == 'SearchInfo' or status != 'READY':
+                self.write(SearchInfoResponse.format(status))
+            else:
+                xml = self.xml() if callable(self.xml) else self.xml
+                if self.get_argument('ALIGNMENTS', None) is not None:
+                    xml = truncate_hits(xml, int(self.get_argument('ALIGNMENTS')))
+                self.set_header('Content-Type', 'text/xml')
+                self.write(xml)
+        elif cmd == 'Delete':
+            self.searches.pop(self.get_argument('RID'), None)
+        else:
+            self.send_error(400)
+
+    post = get
+
+def truncate_hits(xml, n):
+    """The BLAST XML document xml with only the first n hits of each iteration"""
+    root = ElementTree.fromstring(xml)
+    for hits in root.iter('Iteration_hits'):
+        for hit in list(hits)[n:]:
+            hits.remove(hit)
+    return ElementTree.tostring(root, encoding='unicode')
+
+def make_app(xml, waittime=0):
+    """
+    Parameters
+    ----------
+    xml : str or callable
+        The BLAST XML returned for every finished search, or a function returning it
+    waittime : float (optional)
+        Seconds after submission at which a search becomes READY
+    Returns
+    -------
+    application : tornado.web.Application
+        Serves the stand-in at /blast/Blast.cgi. Set blast.BlastURL to http://<host>:<port>/blast/Blast.cgi to use it.
+    """
+    return Application([
+        (r"/blast/Blast.cgi", BlastCGIHandler, {'SEARCHES': {}, 'XML': xml, 'WAITTIME': waittime}),
+    ])
+
+if __name__ == "__main__":
+    #Usage: python mock_ncbi.py blast_results.xml [port] [waittime]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8890
+    waittime = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    make_app(open(sys.argv[1]).read(), waittime).listen(port)
+    IOLoop.current().start()
@@ -1,23 +1,245 @@
-import re,blast
+import os,re,sys,json,inspect,hashlib,cProfile,pstats,blast,metrics
 import redis
+from collections import OrderedDict
 from uuid import uuid4
-from bs4 import BeautifulSoup
 from time import sleep,time
-from tornado.ioloop import IOLoop
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+from tornado.concurrent import Future
 from tornado import gen
 from tornado.web import RequestHandler, Application
+from tornado.log import access_log
+from tornado.websocket import WebSocketHandler
+from tornado.iostream import StreamClosedError
 
 blast_polling_period = 60 #Number of seconds to wait between blast queries -- minimum sixty seconds according to the blast docs
 blast_rid_lifetime = 60*60 #Cache results for 24 hours -- blast says it caches for approximately 36 hours fwiw
 redis_url  = "localhost"
 redis_port = 6379
 numhits = 3000 #Number of blast hits to ask for. During production this should be 20000
+result_cache_size = 32 #Number of deserialized blast results to keep in memory
+ncbi_request_interval = 10 #Minimum number of seconds between requests to NCBI, submissions and status checks alike, across all workers -- the blast docs ask for at least ten
+client_refresh_period = 30 #Number of seconds a waiting browser is held before it reloads. This does not contact NCBI.
+result_lifetime = 7*24*60*60 #Keep parsed results for a week so identical submissions are answered without NCBI
+search_parameters = {'DATABASE' : 'nr', 'PROGRAM' : 'blastp', 'HITLIST_SIZE' : numhits} #Options for every blast search
+search_backend = 'remote' #'remote' to search at NCBI or 'local' to search local_database on this machine
+local_database = blast.LocalDatabase #FASTA file or blast database searched by the local backend
+local_polling_period = 1 #Number of seconds between status checks of local searches
+local_cleanup_period = 10*60 #Number of seconds between removals of local search results older than blast_rid_lifetime
+batch_max_queries = 50 #Maximum number of sequences packed into one multi-FASTA search
+batch_max_residues = 10000 #Maximum total length of the sequences packed into one multi-FASTA search
+cpu_workers = 2 #Number of processes per tornado worker that parse results and score mutants. 0 does this work on the IOLoop.
+tornado_workers = 1 #Number of forked tornado processes sharing the redis server. 0 forks one per CPU core.
+port = 8889
+partial_hits = 500 #Number of top hits downloaded and served first while the rest of a search downloads. 0 waits for every hit.
+export_page_size = 1000 #Number of hits the export endpoint formats per CPU task and sends per chunk
+profile_requests = False #Allow ?profile=1 on any page to profile that request with cProfile. Keep this off in production.
+profile_dir = "profiles" #Where the stats of profiled requests are written
+metrics_push_period = 15 #Number of seconds between the copies each tornado worker makes of its metrics in redis for /metrics
+
+HANDLER_SECONDS = metrics.timer('repx_handler_seconds', "Time spent serving each request by handler, method and status")
+CPU_TASK_SECONDS = metrics.timer('repx_cpu_task_seconds', "Time from submitting a CPU task to its result, including time queued for the pool")
+REDIS_COMMANDS = metrics.counter('repx_redis_commands_total', "Redis commands sent, counting each command in a pipeline")
+CACHE_REQUESTS = metrics.counter('repx_cache_requests_total', "Lookups in the result and profile caches by outcome")
+PENDING_RIDS = metrics.gauge('repx_pending_rids', "Number of RIDs waiting to be checked", lambda: 0)
+WORKER_ID = 0 #The task id of this tornado worker, which labels its metrics
 
 def sanitize(seq):
     """sanitize(str): convert fasta or bare sequence to bare sequence with no whitespace. returns a string of upper case letters"""
-    seq = u''.join([re.sub(r"^s+", "", i.strip()) for i in seq.split(u'\n') if i[0] != '>']) #In case of FASTA
+    seq = u''.join([re.sub(r"^s+", "", i.strip()) for i in seq.split(u'\n') if i.strip() and i.strip()[0] != '>']) #In case of FASTA
     return seq.upper()
 
+def new_handle(query):
+    """new_handle(str): a blast.search_backend for query of the type chosen by search_backend"""
+    if search_backend == 'local':
+        return blast.local_handle(query, local_database)
+    return blast.async_blast_handle(query)
+
+async def maybe_await(value):
+    """maybe_await(object): the result of a search_backend method, whether or not the backend is asynchronous"""
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+def submission_digest(seq, **kw):
+    """submission_digest(str, **kwargs): content address of a blast search for seq with the blast_handle.request options kwargs"""
+    return hashlib.sha256(json.dumps([seq, sorted(kw.items())]).encode('utf-8')).hexdigest()
+
+def search_digest(seq):
+    """search_digest(str): content address of a search for seq with this server's backend and search_parameters"""
+    if search_backend == 'local':
+        return submission_digest(seq, BACKEND=search_backend, LOCAL_DATABASE=local_database, **search_parameters)
+    return submission_digest(seq, **search_parameters)
+
+def claim(db, seq):
+    """
+    Find or reserve the search for seq. Identical submissions share one search and one result.
+
+    Parameters
+    ----------
+    db : redis.StrictRedis
+    seq : str
+        A sanitized sequence
+    Returns
+    -------
+    uid : str
+        The uid the client should follow
+    status : str
+        'pending' if an identical search is in flight, 'finished' if its results already exist, or 'claimed' if 
+        the caller must submit the search for uid with submit
+    """
+    digest = search_digest(seq)
+    uid = db.get("submission:{}".format(digest))
+    if uid is not None and db.exists(job_key(uid.decode())):
+        #An identical search is in flight or recently finished
+        return uid.decode(), 'pending'
+
+    uid = str(uuid4())
+    if db.exists("result:{}".format(digest)):
+        #An identical search finished a while ago
+        set_job(db, uid, status='finished', created=time(), finished=time(), sequence=seq, digest=digest, result="result:{}".format(digest))
+        return uid, 'finished'
+
+    set_job(db, uid, status='provisional', created=time(), sequence=seq, digest=digest)
+    if not db.set("submission:{}".format(digest), uid, nx=True, ex=blast_rid_lifetime):
+        #Somebody else submitted the same search since we looked, join theirs
+        db.delete(job_key(uid))
+        return db.get("submission:{}".format(digest)).decode(), 'pending'
+    return uid, 'claimed'
+
+def batches(claims, max_queries=batch_max_queries, max_residues=batch_max_residues):
+    """batches(list): split (uid, seq) pairs into lists that fit in one multi-FASTA search"""
+    batch,residues = [],0
+    for uid,seq in claims:
+        if len(batch) > 0 and (len(batch) >= max_queries or residues + len(seq) > max_residues):
+            yield batch
+            batch,residues = [],0
+        batch.append((uid, seq))
+        residues += len(seq)
+    if len(batch) > 0:
+        yield batch
+
+async def submit(db, scheduler, claims):
+    """
+    Search for claimed sequences with as few requests as possible. Sequences are packed into multi-FASTA queries
+    and each uid records which <Iteration> of its search's results is its own. Each search waits its turn under the
+    scheduler's NCBI rate limit.
+
+    Parameters
+    ----------
+    db : redis.StrictRedis
+    scheduler : BlastScheduler
+    claims : list
+        (uid, seq) pairs for which claim returned 'claimed'
+    """
+    batches_ = list(batches(claims))
+    for n,batch in enumerate(batches_):
+        if len(batch) == 1:
+            query = batch[0][1]
+        else:
+            query = ''.join(">{}\n{}\n".format(uid, seq) for uid,seq in batch)
+        h = new_handle(query)
+        try:
+            await scheduler.throttle()
+            rid, waittime = await maybe_await(h.request(**search_parameters))
+        except Exception as e:
+            #Fail this batch and the ones not yet submitted, which tells clients that joined them and releases their
+            #submissions so identical submissions are not left waiting
+            fail_jobs(db, [uid for uid,seq in sum(batches_[n:], [])], e)
+            raise
+        pipe = db.pipeline()
+        for iteration,(uid,seq) in enumerate(batch):
+            print(uid, rid, waittime, iteration)
+            set_job(pipe, uid, status='submitted', uptime=time(), rid=rid, waittime=waittime, iteration=iteration) #I think we need to maintain some state here to not be evil
+        pipe.execute()
+        scheduler.add(rid, [uid for uid,seq in batch], waittime)
+
+def job_key(uid):
+    """job_key(str): the redis key of the job record of uid"""
+    return "job:{}".format(uid)
+
+def set_job(db, uid, **kw):
+    """
+    Write fields into the job record of uid, a redis hash, and renew its lifetime. The two commands are sent as one
+    transaction, or queued on db if it is already a pipeline. The fields are
+
+        status     'provisional' until the search is submitted, 'submitted' until it finishes, 'partial' once its
+                   top hits are available and 'finished' once all of them are, or 'failed' if it ended without 
+                   results
+        created    when the job was claimed
+        uptime     when the search was submitted
+        finished   when the results were stored
+        sequence   the query sequence
+        digest     the content address of the search, see search_digest
+        rid        the RID of the search
+        waittime   the WAITTIME NCBI returned for the search
+        iteration  which query of a multi-query search is this job's
+        result     the redis key of the packed results
+        error      why the search failed, or why a partial search will not get the rest of its hits
+    """
+    pipe = db if isinstance(db, redis.client.Pipeline) else db.pipeline()
+    pipe.hset(job_key(uid), mapping=kw)
+    pipe.expire(job_key(uid), blast_rid_lifetime)
+    if pipe is not db:
+        pipe.execute()
+
+def has_results(status):
+    """has_results(str): can a job with this status be answered from its results, whether complete or partial. Failed jobs have none."""
+    return status in ('finished', 'partial')
+
+def fail_jobs(db, uids, error):
+    """
+    Mark the jobs uids as 'failed' and publish "failed" to their clients. Their submissions are released so the
+    same sequence starts a new search when it is next submitted. Jobs which already have the top hits of a partial
+    download keep them and stay 'partial', with the error recorded so clients are told the rest will not arrive.
+
+    Parameters
+    ----------
+    db : redis.StrictRedis
+    uids : list
+    error : Exception or str
+        Why the search failed
+    """
+    pipe = db.pipeline()
+    for uid in uids:
+        pipe.hmget(job_key(uid), 'status', 'digest')
+    jobs = [(uid, status.decode(), digest.decode()) for uid,(status,digest) in zip(uids, pipe.execute()) if status is not None and digest is not None]
+    pipe = db.pipeline()
+    for uid,status,digest in jobs:
+        pipe.get("submission:{}".format(digest))
+    submissions = pipe.execute()
+
+    pipe = db.pipeline()
+    for (uid,status,digest),submission in zip(jobs, submissions):
+        if submission is not None and submission.decode() == uid:
+            pipe.delete("submission:{}".format(digest))
+        if not has_results(status):
+            set_job(pipe, uid, status='failed', finished=time(), error=str(error))
+            pipe.publish("blast:{}".format(uid), "failed")
+        elif status == 'partial':
+            set_job(pipe, uid, finished=time(), error=str(error))
+    pipe.execute()
+
+def status_event(status):
+    """status_event(str): the event a client waiting on a job with this status should be sent, or None if it should keep waiting"""
+    return {None: 'missing', 'finished': 'ready', 'partial': 'partial', 'failed': 'failed'}.get(status)
+
+def get_job(db, uid):
+    """get_job(redis.StrictRedis, str): the fields of the job record of uid as a dictionary of strings or None if it does not exist"""
+    job = db.hgetall(job_key(uid))
+    if len(job) == 0:
+        return None
+    return {k.decode() : v.decode() for k,v in job.items()}
+
+def job_status(db, uid):
+    """job_status(redis.StrictRedis, str): the status of the job uid or None if it does not exist"""
+    status = db.hget(job_key(uid), 'status')
+    return None if status is None else status.decode()
+
 def is_sane(seq):
     """is_sane(str): are all characters in str.upper() amino acids, return True or False"""
     if re.search(r'[^ACDEFGHIKLMNPQRSTVWY]', seq.upper()) is None:
@@ -25,31 +247,466 @@ def is_sane(seq):
     else:
         return False
 
-class MainHandler(RequestHandler):
+class ResultCache():
+    """
+    An in-process LRU cache of blast.blast_results objects loaded from the binary form stored in redis. Finished
+    jobs point at their results with the "result" field of their job record, and results are cached by that key so
+    uids sharing a result share the cached object. Every process running CPU tasks keeps its own.
+    """
+    def __init__(self, maxsize=result_cache_size):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+
+    def get(self, key, value=None):
+        """
+        Parameters
+        ----------
+        key : str
+            The redis key of the results, "result:<digest>"
+        value : bytes (optional)
+            The packed results stored under key. They are loaded if key is not already cached.
+        Returns
+        -------
+        results : blast.blast_results
+            The results or None if they are not cached and value was not given
+        """
+        if key in self.results:
+            CACHE_REQUESTS.inc(cache='results', result='hit')
+            self.results.move_to_end(key)
+            return self.results[key]
+        if value is None:
+            CACHE_REQUESTS.inc(cache='results', result='miss')
+            return None
+        results = blast.loads(value)
+        self.results[key] = results
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+        return results
+
+class ResultMissing(Exception):
+    """Raised by a CPU task when the results it needs are not cached in the process it runs in"""
+    pass
+
+RESULTS = ResultCache() #The results cached by this process
+
+def result_sequence(key, value=None):
+    """result_sequence(str, bytes): CPU task returning the query sequence of the results stored under key"""
+    results = RESULTS.get(key, value)
+    if results is None:
+        raise ResultMissing(key)
+    return results.sequence
+
+def result_recommend(key, residues, value=None):
+    """result_recommend(str, list, bytes): CPU task returning the recommended blast.blast_hit for residues and its formatted alignment, or (None, None)"""
+    results = RESULTS.get(key, value)
+    if results is None:
+        raise ResultMissing(key)
+    hit = results.recommend_mutant(residues)
+    if hit is None:
+        return None, None
+    return hit, str(hit)
+
+def result_profile(key, weighted, value=None):
+    """result_profile(str, bool, bytes): CPU task returning the conservation profile of the results stored under key as JSON"""
+    results = RESULTS.get(key, value)
+    if results is None:
+        raise ResultMissing(key)
+    return format_profile(results, weighted)
+
+def result_export(key, format, start, stop, value=None):
+    """result_export(str, str, int, int, bytes): CPU task returning hits start to stop of the results stored under key as export text and the total number of hits"""
+    results = RESULTS.get(key, value)
+    if results is None:
+        raise ResultMissing(key)
+    return ''.join(results.export(format, start, stop)), len(results.uids)
+
+def parse_results(xml, queries):
+    """parse_results(str, list): CPU task returning the packed blast.blast_results of each query in the blast XML with its unweighted and weighted profiles"""
+    return [(blast.dumps(results), format_profile(results), format_profile(results, True)) for results in blast.split_iterations(xml, queries)]
+
+def format_profile(results, weighted=False):
+    """format_profile(blast.blast_results, bool): the conservation profile of results as a JSON document"""
+    counts, frequencies, entropy = results.profile(weighted)
+    return json.dumps({
+        'sequence'    : results.sequence,
+        'alphabet'    : blast.ProfileAlphabet,
+        'hits'        : len(results.uids),
+        'weighted'    : weighted,
+        'counts'      : counts.round(4).tolist() if weighted else counts.astype(int).tolist(),
+        'frequencies' : frequencies.round(4).tolist(),
+        'entropy'     : entropy.round(4).tolist(),
+    })
+
+def profile_key(key, weighted=False):
+    """profile_key(str, bool): the redis key of the profile cached alongside the results stored under key"""
+    return "profile:{}{}".format(key, ':weighted' if weighted else '')
+
+CPU_POOL = None
+
+def cpu_pool():
+    """cpu_pool(): the process pool CPU tasks run on. It is created on first use so forked tornado workers each get their own."""
+    global CPU_POOL
+    if CPU_POOL is None and cpu_workers > 0:
+        CPU_POOL = ProcessPoolExecutor(cpu_workers)
+    return CPU_POOL
+
+async def run_cpu(fn, *args):
+    """run_cpu(function, *args): the value of fn(*args) computed on the CPU pool so the IOLoop keeps serving other clients"""
+    global CPU_POOL
+    pool = cpu_pool()
+    with CPU_TASK_SECONDS.time(task=fn.__name__):
+        if pool is None:
+            return fn(*args)
+        try:
+            value, changes = await IOLoop.current().run_in_executor(pool, metrics.collect, fn, *args)
+        except BrokenProcessPool:
+            #A worker died, start a new pool for the next task
+            if CPU_POOL is pool:
+                CPU_POOL = None
+            raise
+        except Exception as e:
+            metrics.merge(getattr(e, 'metrics', {}))
+            raise
+    #Bring home what the task recorded in the pool process
+    metrics.merge(changes)
+    return value
+
+async def run_on_result(db, uid, fn, *args):
+    """
+    Run a CPU task on the results of uid, complete or partial. The task is first sent without the packed results in case the 
+    process it lands on has them cached and again with them if it does not.
+
+    Parameters
+    ----------
+    db : redis.StrictRedis
+    uid : str
+    fn : function
+        A CPU task called as fn(key, *args, value) that raises ResultMissing if value is needed but not given
+    Returns
+    -------
+    status : str
+        The status of the job uid, read once for the caller, or None if it does not exist
+    value : object
+        The value of the task or None if uid does not have results yet
+    """
+    status, key = db.hmget(job_key(uid), 'status', 'result')
+    if status is None:
+        return None, None
+    status = status.decode()
+    if not has_results(status):
+        return status, None
+    key = key.decode()
+    try:
+        return status, await run_cpu(fn, key, *args)
+    except ResultMissing:
+        value = db.get(key)
+        if value is None:
+            return status, None
+        return status, await run_cpu(fn, key, *args, value)
+
+class BlastScheduler():
+    """
+    Polls NCBI for every pending search on behalf of all clients. Pending RIDs live in the redis sorted set
+    "pending", scored by the time they are next due to be checked, and the uids waiting on a RID live in the redis
+    set "rid:<RID>". The scheduler checks at most one RID every ncbi_request_interval seconds across every worker
+    sharing the redis server and never checks a single RID more often than blast_polling_period. Submissions take
+    their turns under the same limit, the redis key "ncbi:throttle", through throttle. When a search is 
+    READY its results are downloaded, parsed once and stored under the content address of each waiting uid's 
+    submission, "result:<digest>", which the uid's job record then points to. 
+
+    With partial hits, the first download of a READY search asks only for its top scoring hits. They are stored
+    under "partial:<digest>" and the uids are marked 'partial' so clients can use them at once. The RID is then 
+    marked "ready:<RID>" and put back in "pending" to download every hit on its next turn.
+
+    Errors which may pass, TransientErrors, put the RID back in "pending" for its next turn. Any other error, 
+    such as a FAILED search or results which cannot be parsed, fails the uids waiting on it with fail_jobs.
+    """
+    TransientErrors = (blast.ConnectivityError, BrokenProcessPool)
+
+    def __init__(self, db, period=blast_polling_period, interval=ncbi_request_interval, partial=partial_hits):
+        """
+        Parameters
+        ----------
+        db : redis.StrictRedis
+        period : float (optional)
+            Minimum number of seconds between status checks of the same RID
+        interval : float (optional)
+            Minimum number of seconds between any two requests to NCBI, status checks or submissions
+        partial : int (optional)
+            Number of top hits to download first. 0 downloads every hit at once.
+        """
+        self.db = db
+        self.period = period
+        self.interval = interval
+        self.partial = partial
+        self.callback = None
+
+    def add(self, rid, uids, waittime=0):
+        """
+        Parameters
+        ----------
+        rid : str
+            The NCBI request id
+        uids : str or list
+            The uid or uids that are waiting on the search
+        waittime : int (optional)
+            The WAITTIME NCBI returned for the search. The first status check is scheduled after it has elapsed.
+        """
+        waittime = waittime if isinstance(waittime, int) else 0
+        pipe = self.db.pipeline()
+        pipe.sadd("rid:{}".format(rid), *([uids] if isinstance(uids, str) else uids))
+        pipe.expire("rid:{}".format(rid), blast_rid_lifetime)
+        pipe.zadd("pending", {rid: time() + max(waittime, self.period)})
+        pipe.execute()
+
+    def start(self, tick=1.):
+        """Check for due RIDs every tick seconds on the current IOLoop"""
+        self.callback = PeriodicCallback(self.poll, 1000*tick)
+        self.callback.start()
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.stop()
+
+    async def poll(self):
+        """Check the most overdue RID if the shared NCBI rate limit allows it. Without a rate limit check every due RID."""
+        for rid,due in self.db.zrangebyscore("pending", 0, time(), withscores=True):
+            #zrem only succeeds for one worker, which then owns this check
+            if not self.db.zrem("pending", rid):
+                continue
+            rid = rid.decode()
+            if self.db.scard("rid:{}".format(rid)) == 0:
+                print("No uids are waiting on RID: {}".format(rid))
+                continue
+            #Only now is a turn worth taking
+            if not self.take_turn():
+                self.db.zadd("pending", {rid: due})
+                return
+            await self.check(rid)
+            if self.interval > 0:
+                return
+
+    def take_turn(self):
+        """Claim the next request to NCBI under the rate limit shared by every worker. Returns False if it is too soon."""
+        return self.interval <= 0 or bool(self.db.set("ncbi:throttle", 1, nx=True, px=int(1000*self.interval)))
+
+    async def throttle(self):
+        """Wait until take_turn succeeds"""
+        while not self.take_turn():
+            #pttl is negative if the key expired since we tried
+            await gen.sleep(max(self.db.pttl("ncbi:throttle"), 10)/1000.)
+
+    async def check(self, rid):
+        """
+        Check the status of rid and store its results if it is ready, otherwise reschedule it
+        """
+        uids = [i.decode() for i in self.db.smembers("rid:{}".format(rid))]
+        if len(uids) == 0:
+            print("No uids are waiting on RID: {}".format(rid))
+            return
+
+        handle = new_handle(None)
+        handle.rid = rid
+        try:
+            ready = self.db.exists("ready:{}".format(rid))
+            if ready:
+                #The top hits are in and the search is known to be READY
+                status = handle.status = True
+            else:
+                print("Checking status for RID: {}".format(rid))
+                status = await maybe_await(handle.check_status())
+                print("Status {} for RID: {}".format(status, rid))
+            if status == True and self.partial > 0 and not ready:
+                xml = await maybe_await(handle.fetch_result(ALIGNMENTS=self.partial, DESCRIPTIONS=self.partial))
+                await self.finish(rid, uids, xml, partial=True)
+                pipe = self.db.pipeline()
+                pipe.set("ready:{}".format(rid), 1, ex=blast_rid_lifetime)
+                pipe.zadd("pending", {rid: time()})
+                pipe.execute()
+                return
+            elif status == True:
+                await self.finish(rid, uids, await maybe_await(handle.fetch_result()))
+                return
+        except self.TransientErrors as e:
+            print("Failed to check RID: {} ({})".format(rid, e))
+        except Exception as e:
+            print("Search failed for RID: {} ({}: {})".format(rid, type(e).__name__, e))
+            fail_jobs(self.db, uids, e)
+            self.db.delete("rid:{}".format(rid), "ready:{}".format(rid))
+            return
+        self.db.zadd("pending", {rid: time() + self.period})
+
+    async def finish(self, rid, uids, xml, partial=False):
+        """
+        Parse the results of rid and store them for every uid waiting on it. The XML is parsed once on the CPU pool
+        and each uid gets the <Iteration> of its own query. If partial, the XML holds only the top hits, which are
+        stored until the rest arrive.
+        """
+        pipe = self.db.pipeline()
+        for uid in uids:
+            pipe.hmget(job_key(uid), 'status', 'sequence', 'digest', 'iteration')
+        states = {}
+        for uid,(status,sequence,digest,iteration) in zip(uids, pipe.execute()):
+            if status is not None and status != b'finished':
+                states[uid] = {'sequence': sequence.decode(), 'digest': digest.decode(), 'iteration': int(iteration or 0)}
+        iterations = {state['iteration'] : state['sequence'] for state in states.values()}
+        queries = [iterations.get(i) for i in range(max(iterations, default=-1) + 1)]
+        parsed = await run_cpu(parse_results, xml, queries)
+
+        #Partial results are kept apart so identical submissions are never answered from them as if complete
+        lifetime = blast_rid_lifetime if partial else result_lifetime
+        pipe = self.db.pipeline()
+        for uid,state in states.items():
+            key = "{}:{}".format('partial' if partial else 'result', state['digest'])
+            packed, profile, weighted_profile = parsed[state['iteration']]
+            pipe.setex(key, lifetime, packed)
+            pipe.setex(profile_key(key), lifetime, profile)
+            pipe.setex(profile_key(key, True), lifetime, weighted_profile)
+            if partial:
+                set_job(pipe, uid, status='partial', result=key)
+                pipe.publish("blast:{}".format(uid), "partial")
+            else:
+                set_job(pipe, uid, status='finished', finished=time(), result=key)
+                pipe.publish("blast:{}".format(uid), "ready")
+        if not partial:
+            pipe.delete("rid:{}".format(rid), "ready:{}".format(rid))
+        pipe.execute()
+
+class Notifier():
+    """
+    Relays the messages BlastScheduler publishes on the redis channels "blast:<uid>" when a search finishes to
+    callbacks on this worker's IOLoop. Every worker runs its own Notifier, so browsers are told at once whichever
+    worker they are connected to. If the connection to redis drops, the pubsub thread reconnects and every
+    watcher is sent the current status of its job in case its message was missed.
+    """
+    def __init__(self, db, retry_delay=1.):
+        """
+        Parameters
+        ----------
+        db : redis.StrictRedis
+        retry_delay : float (optional)
+            Seconds to wait before reconnecting after an error
+        """
+        self.db = db
+        self.retry_delay = retry_delay
+        self.watchers = {}
+        self.io_loop = None
+        self.thread = None
+
+    def start(self):
+        """Listen for messages on a background thread and dispatch them on the current IOLoop"""
+        self.io_loop = IOLoop.current()
+        pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{"blast:*": self.on_message})
+        self.thread = pubsub.run_in_thread(sleep_time=1., daemon=True, exception_handler=self.on_error)
+
+    def on_error(self, error, pubsub, thread):
+        #Called from the pubsub thread, which resubscribes when it next reads
+        print("Lost the redis pubsub connection ({}), reconnecting".format(error))
+        sleep(self.retry_delay)
+        self.io_loop.add_callback(self.resync)
+
+    def resync(self):
+        """Send every watcher the event for the current status of its job, if it is no longer waiting"""
+        for uid in list(self.watchers):
+            try:
+                event = status_event(job_status(self.db, uid))
+            except redis.ConnectionError:
+                return
+            if event is not None:
+                self.notify(uid, event)
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.stop()
+
+    def on_message(self, message):
+        #Called from the pubsub thread
+        uid = message['channel'].decode().split(':', 1)[1]
+        self.io_loop.add_callback(self.notify, uid, message['data'].decode())
+
+    def notify(self, uid, event):
+        for callback in list(self.watchers.get(uid, ())):
+            callback(event)
+
+    def watch(self, uid, callback):
+        """Call callback(event) whenever an event is published for uid"""
+        self.watchers.setdefault(uid, set()).add(callback)
+
+    def unwatch(self, uid, callback):
+        callbacks = self.watchers.get(uid, set())
+        callbacks.discard(callback)
+        if len(callbacks) == 0:
+            self.watchers.pop(uid, None)
+
+    def wait(self, uid, timeout):
+        """
+        Parameters
+        ----------
+        uid : str
+        timeout : float
+            Number of seconds to wait
+        Returns
+        -------
+        future : Future
+            Resolves to the next event published for uid or to None after timeout seconds
+        """
+        future = Future()
+        def callback(event):
+            if not future.done():
+                future.set_result(event)
+        self.watch(uid, callback)
+        future.add_done_callback(lambda f: self.unwatch(uid, callback))
+        IOLoop.current().call_later(timeout, callback, None)
+        return future
+
+PROFILING = None #The handler being profiled in this process, cProfile can only run one profiler at a time
+
+class ProfiledHandler(RequestHandler):
+    """
+    A RequestHandler that profiles the request with cProfile when profile_requests is on and the request has
+    profile=1. The stats are written to profile_dir and the slowest calls are printed. The profiler sees everything
+    the IOLoop runs while the request is open, so profile requests one at a time.
+    """
+    def prepare(self):
+        global PROFILING
+        self.profiler = None
+        if profile_requests and self.get_argument('profile', '0') == '1' and PROFILING is None:
+            PROFILING = self
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def on_finish(self):
+        global PROFILING
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        PROFILING = None
+        os.makedirs(profile_dir, exist_ok=True)
+        filename = os.path.join(profile_dir, "{}-{}-{}.prof".format(type(self).__name__, self.request.method, int(1000*time())))
+        self.profiler.dump_stats(filename)
+        print("Profiled {} {} in {}".format(self.request.method, self.request.uri, filename))
+        pstats.Stats(self.profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(15)
+
+class MainHandler(ProfiledHandler):
     def initialize(self, **kw):
         self.db = kw['DB']
+        self.scheduler = kw['SCHEDULER']
 
     def get(self, **kw):
         header = kw.get('header', "Please enter your amino acid sequence below:")
         self.render('templates/frontpage.html', header = header)
 
-    def post(self):
+    async def post(self):
         seq = self.get_argument("usersequence")
         seq = sanitize(seq)
         if is_sane(seq):
-            h = blast.blast_handle(seq)
-            rid, waittime = h.request(HITLIST_SIZE = numhits)
-            value = """<status>provisional</status>
-            <waittime>{}</waittime>
-            <uptime>{}</uptime>
-            <rid>{}</rid>
-            <sequence>{}</sequence>""".format(waittime, time(), rid, seq)
-
-            uid = str(uuid4())
-            while uid in self.db:
-                uid = uuid4()
-            print(uid, value, blast_rid_lifetime)
-            self.db.setex(uid, blast_rid_lifetime, value) #I think we need to maintain some state here to not be evil
+            uid, status = claim(self.db, seq)
+            if status == 'finished':
+                self.redirect("/sequence/{}".format(uid))
+                return
+            if status == 'claimed':
+                await submit(self.db, self.scheduler, [(uid, seq)])
             #self.("/blast/{}".format(uid))
             self.render("templates/waiting.html", uid=uid)
         elif not is_sane(seq):
@@ -57,89 +714,352 @@ class MainHandler(RequestHandler):
         else:
             self.get()
 
-class BlastHandler(RequestHandler):
+class BatchHandler(ProfiledHandler):
+    """
+    Submit many sequences at once. POST a JSON object {"sequences": [seq, ...]} or {"sequences": {name: seq, ...}}
+    and the response maps each sequence, by position or name, to the uid of its search, its status ('pending', 
+    'partial', 'finished', 'failed' or 'missing') and the urls to follow it.
+    New sequences are packed into as few multi-FASTA searches as batch_max_queries and batch_max_residues allow.
+    A request that cannot be used gets a 400 response with a JSON object explaining the error.
+    """
     def initialize(self, **kw):
         self.db = kw['DB']
+        self.scheduler = kw['SCHEDULER']
 
-    @gen.coroutine
-    def get(self, uid):
-        if uid in self.db:
-            soup = BeautifulSoup(self.db[uid], features='lxml')
-            if soup.status is not None:
-                rid = soup.rid.text
-                handle = blast.blast_handle(soup.sequence.text)
-                handle.rid = rid
-                uptime = float(soup.uptime.text)
-                yield gen.sleep(blast_polling_period)
-                if time() - uptime > blast_polling_period:
-                    print("Checking status for UID: {}".format(uid))
-                    status = handle.check_status()
-                    print("Status {} for UID: {}".format(status, uid))
-                    if status == True:
-                        self.db[uid] = handle.fetch_result() + "\n<sequence>{}</sequence>".format(soup.sequence.text)
-                        self.redirect("/sequence/{}".format(uid))
-                    elif status == False:
-                        soup.uptime.string = str(time())
-                        self.db[uid] = str(soup)
-                        self.redirect("/blast/{}".format(uid))
-                    else:
-                        raise TypeError("blast_handle.check_status returned a variable of type: {}".format(type(status)))
-                else:
-                    self.get(uid)
-            else:
-                self.redirect('/sequence/{}'.format(uid))
+    async def post(self):
+        try:
+            sequences = json.loads(self.request.body)['sequences']
+        except (ValueError, KeyError, TypeError):
+            self.set_status(400)
+            self.write({'error': 'Expected a JSON object with a "sequences" list or object'})
+            return
+        if isinstance(sequences, dict):
+            names, sequences = list(sequences.keys()), list(sequences.values())
+        elif isinstance(sequences, list):
+            names = None
         else:
-            self.redirect('/')
+            self.set_status(400)
+            self.write({'error': '"sequences" must be a list or object'})
+            return
+
+        sequences = [sanitize(seq) if isinstance(seq, str) and seq.strip() else '' for seq in sequences]
+        invalid = [i for i,seq in enumerate(sequences) if len(seq) == 0 or not is_sane(seq)]
+        if len(sequences) == 0 or len(invalid) > 0:
+            self.set_status(400)
+            self.write({'error': 'Invalid sequence. Ensure all characters are amino acids', 'invalid': [i if names is None else names[i] for i in invalid]})
+            return
 
-class SequenceHandler(RequestHandler):
+        entries,claims = [],[]
+        for seq in sequences:
+            uid, status = claim(self.db, seq)
+            entries.append({'uid': uid, 'status': status, 'sequence': '/sequence/{}'.format(uid), 'notify': '/notify/{}'.format(uid)})
+            if status == 'claimed':
+                claims.append((uid, seq))
+        await submit(self.db, self.scheduler, claims)
+
+        for entry in entries:
+            status = job_status(self.db, entry['uid'])
+            entry['status'] = 'missing' if status is None else status if status in ('partial', 'finished', 'failed') else 'pending'
+        if names is None:
+            self.write({'results': entries})
+        else:
+            self.write({'results': dict(zip(names, entries))})
+
+class BlastHandler(ProfiledHandler):
     def initialize(self, **kw):
         self.db = kw['DB']
+        self.notifier = kw['NOTIFIER']
 
-    def get(self, uid):
-        if uid in self.db:
-            soup = BeautifulSoup(self.db[uid], features='lxml')
-            if soup.status is None:
-                sequence = soup.sequence.text
-                self.render("templates/userprefs.html", sequence=sequence, uid=uid)
-            else:
+    async def get(self, uid):
+        #BlastScheduler does the polling. This is a long poll for browsers without websockets.
+        status = job_status(self.db, uid)
+        if status is not None and status != 'failed' and not has_results(status):
+            event = await self.notifier.wait(uid, client_refresh_period)
+            if event is None:
                 self.redirect("/blast/{}".format(uid))
+                return
+            status = job_status(self.db, uid)
+        if status is None:
+            self.redirect('/')
+        elif status == 'failed':
+            self.render('templates/frontpage.html', header="The search for this sequence failed. Please submit it again:")
+        else:
+            self.redirect('/sequence/{}'.format(uid))
+
+class NotifyHandler(WebSocketHandler):
+    """
+    Sends "ready" to the browser as soon as the search for uid has finished, "partial" as soon as its top hits
+    are available or "failed" if it ended without results, and then closes. Without news after
+    client_refresh_period seconds it closes anyway and the browser falls back to the long poll.
+    """
+    def initialize(self, **kw):
+        self.db = kw['DB']
+        self.notifier = kw['NOTIFIER']
+        self.uid = None
+        self.timeout = None
+
+    def open(self, uid):
+        self.uid = uid
+        self.notifier.watch(uid, self.on_event)
+        self.timeout = IOLoop.current().call_later(client_refresh_period, self.close)
+        #The search may have finished before we started watching
+        event = status_event(job_status(self.db, uid))
+        if event is not None:
+            self.on_event(event)
+
+    def on_event(self, event):
+        self.notifier.unwatch(self.uid, self.on_event)
+        self.write_message(event)
+        self.close()
+
+    def on_close(self):
+        if self.uid is not None:
+            self.notifier.unwatch(self.uid, self.on_event)
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+
+class SequenceHandler(ProfiledHandler):
+    def initialize(self, **kw):
+        self.db = kw['DB']
+
+    async def get(self, uid):
+        status, sequence = await run_on_result(self.db, uid, result_sequence)
+        if sequence is not None:
+            #A partial job with an error will not get the rest of its hits
+            error = self.db.hget(job_key(uid), 'error') if status == 'partial' else None
+            self.render("templates/userprefs.html", sequence=sequence, uid=uid, partial=status == 'partial', failed=error is not None)
+        elif status is not None:
+            self.redirect("/blast/{}".format(uid))
         else:
             self.redirect("/".format(uid))
 
-    def post(self, uid):
-        if uid in self.db:
-            results = blast.blast_results(self.db[uid])
-            if results.soup.status is None:
-                try:
-                    mutants = self.get_arguments('mutant')
-                    mutants = list(map(int, mutants))
-                    hit = results.recommend_mutant(mutants)
-                    print(hit)
-                    print(type(hit))
-                    if hit is None:
-                        self.render("templates/nohit.html")
-                    self.render("templates/hit.html", hit=hit, mutants=mutants, uid=uid)
-                except:
-                    self.redirect("/sequence/{}".format(uid))
-                
+    async def post(self, uid):
+        try:
+            mutants = self.get_arguments('mutant')
+            mutants = list(map(int, mutants))
+            status, value = await run_on_result(self.db, uid, result_recommend, mutants)
+        except:
+            self.redirect("/sequence/{}".format(uid))
+            return
+        if value is not None:
+            hit, alignment = value
+            if hit is None:
+                self.render("templates/nohit.html", uid=uid)
             else:
-                self.redirect("/blast/{}".format(uid))
+                self.render("templates/hit.html", hit=hit, alignment=alignment, mutants=mutants, uid=uid)
+        elif status is not None:
+            self.redirect("/blast/{}".format(uid))
         else:
             self.redirect("/")
 
-RID_DB = redis.StrictRedis(host=redis_url, port=redis_port, db=0)
-RID_DB.set('debug', open('blast_results.xml').read())
+class ProfileHandler(ProfiledHandler):
+    """
+    The conservation profile of a finished search as JSON: the count of every residue at every query position, the
+    amino acid frequencies and the entropy of each position. Pass weighted=1 to weight hits by their scores. While
+    only the top hits of the search have downloaded the profile is of those and the X-Result-Status header is 
+    "partial" rather than "finished".
+    """
+    def initialize(self, **kw):
+        self.db = kw['DB']
+
+    async def get(self, uid):
+        weighted = self.get_argument('weighted', '0').lower() not in ('', '0', 'false')
+        status, result = self.db.hmget(job_key(uid), 'status', 'result')
+        if status is None:
+            self.send_error(404)
+            return
+        elif status == b'failed':
+            self.set_status(410)
+            self.write({'status': 'failed'})
+            return
+        elif not has_results(status.decode()):
+            self.set_status(202)
+            self.write({'status': 'pending'})
+            return
+
+        key = profile_key(result.decode(), weighted)
+        profile = self.db.get(key)
+        CACHE_REQUESTS.inc(cache='profile', result='miss' if profile is None else 'hit')
+        if profile is None:
+            #Results stored before profiles were, or the debug results
+            _, profile = await run_on_result(self.db, uid, result_profile, weighted)
+            if profile is None:
+                self.send_error(404)
+                return
+            #The profile must not outlive its results, which are only kept briefly while partial
+            lifetime = self.db.ttl(result)
+            if lifetime == -1:
+                lifetime = result_lifetime
+            if lifetime > 0:
+                self.db.setex(key, lifetime, profile)
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('X-Result-Status', status.decode())
+        self.write(profile)
+
+class ExportHandler(ProfiledHandler):
+    """
+    Download the query registered alignment of every hit of a finished search. Pass format=fasta (the default) for
+    aligned FASTA or format=aligned for one line per sequence. The hits are formatted export_page_size at a time
+    on the CPU pool and each page is flushed to the client before the next is formatted, so the download starts
+    at once and memory use does not grow with the number of hits. The X-Result-Status header is "partial" if only 
+    the top hits of the search have downloaded. If the results change or expire part way through, the connection 
+    is closed without ending the response so the client does not mistake what it has for the whole export.
+    """
+    def initialize(self, **kw):
+        self.db = kw['DB']
+
+    async def get(self, uid):
+        format = self.get_argument('format', 'fasta')
+        if format not in blast.ExportFormats:
+            self.send_error(400, reason="format must be one of {}".format(', '.join(blast.ExportFormats)))
+            return
+        status, value = await run_on_result(self.db, uid, result_export, format, 0, export_page_size)
+        if status is None:
+            self.send_error(404)
+            return
+        elif value is None:
+            self.redirect("/blast/{}".format(uid))
+            return
+
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.set_header('Content-Disposition', 'attachment; filename="{}.{}"'.format(uid, 'fasta' if format == 'fasta' else 'txt'))
+        self.set_header('X-Result-Status', status)
+        start = 0
+        while True:
+            text, total = value
+            self.write(text)
+            try:
+                await self.flush()
+            except StreamClosedError:
+                return
+            start += export_page_size
+            if start >= total:
+                break
+            page_status, value = await run_on_result(self.db, uid, result_export, format, start, start + export_page_size)
+            if value is None or page_status != status:
+                #The results expired, or the rest of a partial search arrived, part way through
+                print("Aborting the export of {} after {} hits".format(uid, start))
+                self.request.connection.close()
+                return
+        self.finish()
 
-application = Application([
-    (r"/", MainHandler, {'DB': RID_DB}),
-    (r"/blast/(.*)", BlastHandler, {'DB': RID_DB}),
-    (r"/sequence/(.*)", SequenceHandler, {'DB' : RID_DB}),
-])
+class MetricsHandler(RequestHandler):
+    """
+    The metrics of every tornado worker in the Prometheus text format, labelled by worker. Whichever worker 
+    accepts the scrape reads the others' from redis, where each copies its own every metrics_push_period seconds.
+    """
+    def initialize(self, **kw):
+        self.db = kw['DB']
+
+    def get(self):
+        push_metrics(self.db)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.exposition(worker_metrics(self.db)))
+
+def push_metrics(db):
+    """push_metrics(redis.StrictRedis): copy the metrics of this worker to redis for /metrics. The copy expires if the worker stops."""
+    db.set("metrics:{}".format(WORKER_ID), metrics.encode(metrics.snapshot()), ex=4*metrics_push_period)
+
+def worker_metrics(db):
+    """worker_metrics(redis.StrictRedis): the metrics every worker copied to redis, keyed by the worker label as metrics.exposition takes them"""
+    keys = sorted(db.scan_iter("metrics:*"))
+    states = {}
+    for key,value in zip(keys, db.mget(keys) if len(keys) > 0 else []):
+        if value is not None:
+            states[(('worker', key.decode().split(':', 1)[1]),)] = metrics.decode(value)
+    return states
+
+def log_request(handler):
+    """log_request(RequestHandler): record the duration of a finished request in HANDLER_SECONDS and write the access log as tornado does"""
+    status, seconds = handler.get_status(), handler.request.request_time()
+    HANDLER_SECONDS.observe(seconds, handler=type(handler).__name__, method=handler.request.method, status=status)
+    if status < 400:
+        log = access_log.info
+    elif status < 500:
+        log = access_log.warning
+    else:
+        log = access_log.error
+    log("%d %s %s (%s) %.2fms", status, handler.request.method, handler.request.uri, handler.request.remote_ip, 1000.*seconds)
+
+class CountedPipeline(redis.client.Pipeline):
+    """A pipeline counting its commands in REDIS_COMMANDS as they are sent"""
+    def execute(self, raise_on_error=True):
+        for command,options in self.command_stack:
+            REDIS_COMMANDS.inc(command=str(command[0]).lower())
+        return super().execute(raise_on_error)
+
+class CountedRedis(redis.StrictRedis):
+    """
+    A redis client counting every command it sends in REDIS_COMMANDS, including the commands of its pipelines. To
+    count the commands sent through another client, such as fakeredis, share its connection pool:
+    CountedRedis(connection_pool=db.connection_pool).
+    """
+    def execute_command(self, *args, **kw):
+        REDIS_COMMANDS.inc(command=str(args[0]).lower())
+        return super().execute_command(*args, **kw)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def load_debug(db):
+    """load_debug(redis.StrictRedis): store the results in blast_results.xml under the uid "debug" to try the app without searching"""
+    db.set('result:debug', blast.dumps(blast.blast_results(open('blast_results.xml'))))
+    db.delete(profile_key('result:debug'), profile_key('result:debug', True))
+    db.delete(job_key('debug'))
+    db.hset(job_key('debug'), mapping={'status': 'finished', 'digest': 'debug', 'result': 'result:debug'})
+
+def make_app(db):
+    """
+    Parameters
+    ----------
+    db : redis.StrictRedis
+        Use a CountedRedis for the redis metrics
+    Returns
+    -------
+    application : tornado.web.Application
+    scheduler : BlastScheduler
+    notifier : Notifier
+        The scheduler and notifier serving application. Start them once the IOLoop is running.
+    """
+    if search_backend == 'local':
+        scheduler = BlastScheduler(db, period=local_polling_period, interval=0, partial=0)
+    else:
+        #There is nothing to gain from a first download as large as the whole result
+        scheduler = BlastScheduler(db, partial=partial_hits if partial_hits < search_parameters['HITLIST_SIZE'] else 0)
+    notifier = Notifier(db)
+    PENDING_RIDS.fn = lambda: db.zcard("pending")
+    application = Application([
+        (r"/", MainHandler, {'DB': db, 'SCHEDULER': scheduler}),
+        (r"/batch", BatchHandler, {'DB': db, 'SCHEDULER': scheduler}),
+        (r"/blast/([^/]+)", BlastHandler, {'DB': db, 'NOTIFIER': notifier}),
+        (r"/notify/([^/]+)", NotifyHandler, {'DB': db, 'NOTIFIER': notifier}),
+        (r"/sequence/([^/]+)/profile", ProfileHandler, {'DB' : db}),
+        (r"/sequence/([^/]+)/export", ExportHandler, {'DB' : db}),
+        (r"/sequence/([^/]+)", SequenceHandler, {'DB' : db}),
+        (r"/metrics", MetricsHandler, {'DB': db}),
+    ], log_function=log_request)
+    return application, scheduler, notifier
 
 if __name__ == "__main__":
     #Don't be a jerk error
-    if blast_polling_period < 60:
+    if search_backend == 'remote' and blast_polling_period < 60:
         raise ValueError("blast_polling_period set to {}. This must be at least sixty seconds to comply with the BLAST terms of service".format(blast_polling_period))
+    if search_backend == 'remote' and blast.CurlAsyncHTTPClient is None:
+        raise ImportError("Searching NCBI needs pycurl. Install it with conda install pycurl")
 
-    application.listen(8889)
+    sockets = bind_sockets(port)
+    task_id = fork_processes(tornado_workers) if tornado_workers != 1 else None
+    WORKER_ID = task_id or 0
+    #Redis connections, threads and process pools are all created after the fork so every worker has its own
+    RID_DB = CountedRedis(host=redis_url, port=redis_port, db=0)
+    if task_id in (None, 0):
+        load_debug(RID_DB)
+    application, SCHEDULER, NOTIFIER = make_app(RID_DB)
+    HTTPServer(application).add_sockets(sockets)
+    SCHEDULER.start()
+    NOTIFIER.start()
+    PeriodicCallback(lambda: push_metrics(RID_DB), 1000*metrics_push_period).start()
+    if search_backend == 'local' and task_id in (None, 0):
+        #RIDs are forgotten after blast_rid_lifetime and the XML is stored in redis once it is fetched
+        PeriodicCallback(lambda: blast.clean_local_results(blast_rid_lifetime), 1000*local_cleanup_period).start()
     IOLoop.instance().start()
@@ -0,0 +1,592 @@
+###############################################################################
+#                                                                             #
+# Tests of blast.py. The NCBI client runs against mock_ncbi.py.               #
+# Run with python -m pytest.                                                  #
+#                                                                             #
+###############################################################################
+
+import io,os,time
+import pytest
+import numpy as np
+import blast, mock_ncbi
+from xml.etree import ElementTree
+from tornado import gen
+from tornado.web import Application
+from tornado.testing import AsyncHTTPTestCase, gen_test, bind_unused_port
+
+def unused_port():
+    """A local port nothing listens on"""
+    sock,port = bind_unused_port()
+    sock.close()
+    return port
+
+class FlakyHandler(mock_ncbi.BlastCGIHandler):
+    """mock_ncbi's Blast.cgi which first answers with each error in FAILURES, an http status or 'timeout'"""
+    def initialize(self, **kw):
+        super().initialize(**kw)
+        self.failures = kw['FAILURES']
+        self.methods = kw['METHODS']
+        self.peers = kw['PEERS']
+
+    async def prepare(self):
+        self.methods.append(self.request.method)
+        self.peers.append(self.request.connection.context.address)
+        if len(self.failures) > 0:
+            failure = self.failures.pop(0)
+            if failure == 'timeout':
+                await gen.sleep(1.)
+                self.finish()
+            else:
+                self.send_error(failure)
+
+class BlastClientTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.searches, self.failures, self.methods, self.peers = {}, [], [], []
+        return Application([
+            (r"/blast/Blast.cgi", FlakyHandler, {'SEARCHES': self.searches, 'XML': '', 'FAILURES': self.failures, 'METHODS': self.methods, 'PEERS': self.peers}),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.blast_url = blast.BlastURL
+        blast.BlastURL = self.get_url('/blast/Blast.cgi')
+
+    def tearDown(self):
+        blast.BlastURL = self.blast_url
+        super().tearDown()
+
+    def handle(self):
+        return blast.async_blast_handle('MKVLAAGIV', timeout=0.2, retries=2, backoff=0.01)
+
+    @gen_test
+    async def test_request(self):
+        handle = self.handle()
+        rid, waittime = await handle.request()
+        assert len(rid) == 11
+        assert waittime == 0
+        assert handle.rid == rid
+        assert self.methods == ['POST']
+
+    def test_parse_put(self):
+        handle = blast.blast_handle('MKVLAAGIV')
+        assert handle.parse_put(mock_ncbi.PutResponse.format('ABC123', 27)) == ('ABC123', 27)
+        assert handle.rid == 'ABC123'
+        with pytest.raises(blast.ConnectivityError):
+            handle.parse_put('<html>Server busy</html>')
+
+    @gen_test
+    async def test_check_status(self):
+        handle = self.handle()
+        await handle.request()
+        assert await handle.check_status() == True
+        assert handle.status == True
+
+        #A search submitted a minute in the future is still running
+        self.searches[handle.rid] += 60
+        assert await handle.check_status() == False
+
+        handle.rid = 'NOTASEARCH1'
+        assert await handle.check_status() == False
+        assert handle.status == False
+
+    def test_parse_status(self):
+        handle = blast.blast_handle('MKVLAAGIV')
+        assert handle.parse_status(mock_ncbi.SearchInfoResponse.format('WAITING')) == False
+        assert handle.parse_status(mock_ncbi.SearchInfoResponse.format('UNKNOWN')) == False
+        assert handle.parse_status(mock_ncbi.SearchInfoResponse.format('READY')) == True
+
+    @gen_test
+    async def test_retry(self):
+        handle = self.handle()
+        handle.rid = 'NOTASEARCH1'
+        self.failures.extend([503, 429])
+        assert await handle.check_status() == False
+        assert self.methods == ['GET']*3
+
+    @gen_test
+    async def test_retry_timeout(self):
+        handle = self.handle()
+        handle.rid = 'NOTASEARCH1'
+        self.failures.append('timeout')
+        assert await handle.check_status() == False
+        assert self.methods == ['GET']*2
+
+    @gen_test
+    async def test_retry_put(self):
+        handle = self.handle()
+        self.failures.append(503)
+        rid, waittime = await handle.request()
+        assert self.methods == ['POST']*2
+
+    @gen_test
+    async def test_put_timeout_is_not_retried(self):
+        #NCBI may have started the search, sending it again would start another
+        handle = self.handle()
+        self.failures.append('timeout')
+        with pytest.raises(blast.ConnectivityError):
+            await handle.request()
+        assert self.methods == ['POST']
+
+    @gen_test
+    async def test_retries_run_out(self):
+        handle = self.handle()
+        handle.rid = 'NOTASEARCH1'
+        self.failures.extend([500]*3)
+        with pytest.raises(blast.ConnectivityError):
+            await handle.check_status()
+        assert self.methods == ['GET']*3
+
+    @gen_test
+    async def test_keep_alive(self):
+        #Every request comes from the same client socket
+        handle = self.handle()
+        await handle.request()
+        await handle.check_status()
+        await handle.fetch_result(FORMAT_OBJECT='SearchInfo')
+        assert len(self.peers) == 3
+        assert len(set(self.peers)) == 1
+
+    @gen_test
+    async def test_put_retried_when_not_sent(self):
+        #Nothing listens on the port, so no search can have started
+        handle = self.handle()
+        blast.BlastURL = 'http://127.0.0.1:{}/blast/Blast.cgi'.format(unused_port())
+        with pytest.raises(blast.ConnectivityError) as e:
+            await handle.request()
+        assert e.value.__cause__.errno in blast.CurlNotSentErrors
+
+    @gen_test
+    async def test_client_error_is_not_retried(self):
+        handle = self.handle()
+        handle.rid = 'NOTASEARCH1'
+        self.failures.append(404)
+        with pytest.raises(blast.ConnectivityError):
+            await handle.check_status()
+        assert self.methods == ['GET']
+
+#Two hits on a ten residue query. B is reported second but scores higher, and only its first HSP counts.
+FixtureXML = """<?xml version="1.0"?>
+<BlastOutput>
+  <BlastOutput_iterations>
+    <Iteration>
+      <Iteration_iter-num>1</Iteration_iter-num>
+      <Iteration_query-len>10</Iteration_query-len>
+      <Iteration_hits>
+        <Hit>
+          <Hit_num>1</Hit_num>
+          <Hit_def>protein A [Homo sapiens]</Hit_def>
+          <Hit_accession>A</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_score>40</Hsp_score>
+              <Hsp_query-from>2</Hsp_query-from>
+              <Hsp_query-to>6</Hsp_query-to>
+              <Hsp_qseq>KV-LAA</Hsp_qseq>
+              <Hsp_hseq>KVRLGA</Hsp_hseq>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>2</Hit_num>
+          <Hit_def>protein B &amp; friends</Hit_def>
+          <Hit_accession>B</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_score>50</Hsp_score>
+              <Hsp_query-from>1</Hsp_query-from>
+              <Hsp_query-to>4</Hsp_query-to>
+              <Hsp_qseq>MKVL</Hsp_qseq>
+              <Hsp_hseq>MRVL</Hsp_hseq>
+            </Hsp>
+            <Hsp>
+              <Hsp_score>30</Hsp_score>
+              <Hsp_query-from>7</Hsp_query-from>
+              <Hsp_query-to>10</Hsp_query-to>
+              <Hsp_qseq>GIVW</Hsp_qseq>
+              <Hsp_hseq>GIVW</Hsp_hseq>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+      </Iteration_hits>
+    </Iteration>
+  </BlastOutput_iterations>
+</BlastOutput>
+"""
+
+def test_iterparse_hits():
+    hits = list(blast.iterparse_hits(FixtureXML))
+    assert [(i, length, fields['accession']) for i,length,fields in hits] == [(0, 10, 'A'), (0, 10, 'B')]
+    #Only the first HSP of B is read
+    assert hits[1][2] == {
+        'accession'  : 'B',
+        'definition' : 'protein B & friends',
+        'score'      : '50',
+        'query_from' : '1',
+        'query_to'   : '4',
+        'qseq'       : 'MKVL',
+        'hseq'       : 'MRVL',
+    }
+
+def test_blast_hit():
+    #The fields blast_hit had when it was read with BeautifulSoup
+    hit = blast.blast_hit(FixtureXML.split('<Iteration_hits>')[1].split('</Iteration_hits>')[0].split('</Hit>')[0] + '</Hit>', 10)
+    assert (hit.accession, hit.definition, hit.score) == ('A', 'protein A [Homo sapiens]', 40.)
+    #Gaps in the query are removed and the hit is padded to the query length
+    assert hit.qseq == '-KVLAA----'
+    assert hit.hseq == '-KVLGA----'
+
+def test_blast_results():
+    results = blast.blast_results(FixtureXML, query='MKVLAAGIVW')
+    assert results.uids == ['B', 'A']
+    assert results.definitions == ['protein B & friends', 'protein A [Homo sapiens]']
+    assert results.scores.tolist() == [50., 40.]
+    assert results.sequence == 'MKVLAAGIVW'
+    assert [i.tobytes().decode() for i in results.alignment] == ['MRVL------', '-KVLGA----']
+    assert [(i.qseq, i.hseq) for i in results.hits] == [('MKVL------', 'MRVL------'), ('-KVLAA----', '-KVLGA----')]
+
+def test_blast_results_without_query():
+    #The query is filled in from the hits and positions no hit covers are gaps
+    assert blast.blast_results(FixtureXML).sequence == 'MKVLAA----'
+
+def test_blast_results_file_like():
+    expected = blast.blast_results(FixtureXML)
+    for XML in [io.StringIO(FixtureXML), io.BytesIO(FixtureXML.encode())]:
+        results = blast.blast_results(XML)
+        assert results.uids == expected.uids
+        assert (results.alignment == expected.alignment).all()
+    #Small chunks split tags across reads
+    assert list(blast.iterparse_hits(io.StringIO(FixtureXML), chunk_size=7)) == list(blast.iterparse_hits(FixtureXML))
+
+def test_parse_errors():
+    for XML in ['this is not xml', '<html><body>Server busy', '']:
+        with pytest.raises(ElementTree.ParseError):
+            blast.blast_results(XML)
+    #Anything after the root element is ignored
+    assert blast.blast_results(FixtureXML + '<trailing>junk &&').uids == ['B', 'A']
+
+def scan_mutants(results, residues):
+    """The rows recommend_mutants should return, found by checking every hit in score order"""
+    rows = []
+    for i,row in enumerate(results.alignment):
+        if all(blast.IsAminoAcid[row[r-1]] and row[r-1] != results.query[r-1] for r in residues):
+            rows.append(i)
+    return rows
+
+def test_recommend_mutants():
+    import random, bench
+    xml,(query,) = bench.synthetic_xml(300, 60, seed=1)
+    results = blast.blast_results(xml, query=query)
+    rng = random.Random(1)
+    for n in range(2000):
+        residues = rng.sample(range(1, 61), rng.randint(1, 3))
+        expected = [results.uids[i] for i in scan_mutants(results, residues)]
+        assert [i.accession for i in results.recommend_mutants(residues, k=None)] == expected
+        #The top k are the first k in score order
+        top = results.recommend_mutants(residues, k=5)
+        assert [i.accession for i in top] == expected[:5]
+        assert [i.score for i in top] == sorted([i.score for i in top], reverse=True)
+        best = results.recommend_mutant(residues)
+        assert (best is None and len(expected) == 0) or best.accession == expected[0]
+
+def test_recommend_mutants_empty():
+    results = blast.blast_results(FixtureXML, query='MKVLAAGIVW')
+    #Position 7 is covered by no hit and position 3 is conserved by both
+    assert results.recommend_mutants([7]) == []
+    assert results.recommend_mutant([3]) is None
+    assert results.recommend_mutant([2]).accession == 'B'
+    empty = blast.blast_results('<BlastOutput></BlastOutput>', query='MKV')
+    assert empty.recommend_mutants([1]) == []
+    assert empty.recommend_mutant([1]) is None
+
+def test_dumps_loads():
+    import bench
+    xml,(query,) = bench.synthetic_xml(100, 40, seed=2)
+    for results in [blast.blast_results(xml, query=query), blast.blast_results(FixtureXML), blast.blast_results('<BlastOutput></BlastOutput>', query='MKV')]:
+        data = blast.dumps(results)
+        assert blast.is_packed(data)
+        loaded = blast.loads(data)
+        for name in ['query', 'alignment', 'scores', 'query_from', 'query_to']:
+            assert (getattr(loaded, name) == getattr(results, name)).all()
+            assert getattr(loaded, name).dtype == getattr(results, name).dtype
+        assert loaded.uids == results.uids
+        assert loaded.definitions == results.definitions
+        assert loaded.substitutions == results.substitutions
+        assert loaded.sequence == results.sequence
+
+def test_loads_rejects_foreign_data():
+    data = blast.dumps(blast.blast_results(FixtureXML))
+    with pytest.raises(ValueError):
+        blast.loads(b'NOPE' + data[4:])
+    with pytest.raises(ValueError):
+        blast.loads(blast.PackMagic + (blast.PackVersion + 1).to_bytes(2, 'big') + data[len(blast.PackMagic) + 2:])
+
+def reference_score(seq1, seq2, gapopen=10., gapextend=0.5):
+    """The best local alignment score by the textbook Gotoh recurrences, one cell at a time"""
+    score = lambda a,b: blast.Blosum62Matrix[blast.Blosum62Index[ord(a)], blast.Blosum62Index[ord(b)]]
+    H = [[0.]*(len(seq2) + 1) for i in range(len(seq1) + 1)]
+    E = [[-np.inf]*(len(seq2) + 1) for i in range(len(seq1) + 1)]
+    F = [[-np.inf]*(len(seq2) + 1) for i in range(len(seq1) + 1)]
+    best = 0.
+    for i in range(1, len(seq1) + 1):
+        for j in range(1, len(seq2) + 1):
+            E[i][j] = max(H[i-1][j] - gapopen, E[i-1][j] - gapextend)
+            F[i][j] = max(H[i][j-1] - gapopen, F[i][j-1] - gapextend)
+            H[i][j] = max(0., H[i-1][j-1] + score(seq1[i-1], seq2[j-1]), E[i][j], F[i][j])
+            best = max(best, H[i][j])
+    return best
+
+def alignment_score(aln1, aln2, gapopen=10., gapextend=0.5):
+    """The score of an alignment as written out"""
+    total,gap = 0.,None
+    for a,b in zip(aln1, aln2):
+        if '-' in (a, b):
+            total -= gapextend if gap == (a == '-') else gapopen
+            gap = (a == '-')
+        else:
+            total += blast.Blosum62Matrix[blast.Blosum62Index[ord(a)], blast.Blosum62Index[ord(b)]]
+            gap = None
+    return total
+
+def random_sequences(n, low, high, seed=0):
+    rng = np.random.RandomState(seed)
+    alphabet = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+    return [''.join(rng.choice(alphabet, rng.randint(low, high))) for i in range(n)]
+
+def test_smith_waterman_reference():
+    query = random_sequences(1, 30, 31, seed=1)[0]
+    #Mutated copies of the query with insertions and deletions, and unrelated sequences
+    targets = random_sequences(6, 5, 40) + [query[:10] + 'WWW' + query[10:], query[:12] + query[16:], query[5:25]]
+    for seq2 in targets:
+        aln = blast.smith_waterman(query, seq2)
+        assert aln.score == pytest.approx(reference_score(query, seq2))
+        if aln.score > 0:
+            #The traceback is an alignment of the two sequences with that score
+            assert alignment_score(*aln.aln) == pytest.approx(aln.score)
+            assert aln.aln[0].replace('-', '') in query
+            assert aln.aln[1].replace('-', '') in seq2
+            assert query[aln.start1:].startswith(aln.aln[0].replace('-', ''))
+            assert seq2[aln.start2:].startswith(aln.aln[1].replace('-', ''))
+
+def test_align_many():
+    query = random_sequences(1, 40, 41, seed=2)[0]
+    targets = random_sequences(12, 1, 80) + [query, '']
+    many = blast.align_many(query, targets)
+    #Small max_cells splits the targets over several batches
+    batched = [blast.smith_waterman(query, seq2, aln=aln) for seq2,aln in zip(targets, blast.smith_waterman_kernel(query, targets, max_cells=4000))]
+    for seq2,a,b in zip(targets, many, batched):
+        single = blast.smith_waterman(query, seq2)
+        assert a.aln == b.aln == single.aln
+        assert a.score == b.score == single.score
+        assert a.registered_seq2 == b.registered_seq2 == single.registered_seq2
+
+def test_smith_waterman_statistics():
+    aln = blast.smith_waterman('MKVLAAGIVW', 'MKVIAAGIVW')
+    assert aln.aln == ('MKVLAAGIVW', 'MKVIAAGIVW')
+    assert (aln.start1, aln.start2) == (0, 0)
+    #L and I differ but score positively in BLOSUM62
+    assert aln.identity == 90.
+    assert aln.similarity == 100.
+    assert aln.registered_seq2 == 'MKVIAAGIVW'
+
+    aln = blast.smith_waterman('MKVLAAGIVWSTNPKPQRK', 'AAGIVW')
+    assert aln.aln == ('AAGIVW', 'AAGIVW')
+    assert aln.start1 == 4
+    assert aln.registered_seq2 == '----AAGIVW---------'
+
+def test_smith_waterman_empty():
+    for seq1,seq2 in [('MKVLAAGIVW', ''), ('', 'MKVLAAGIVW'), ('WWWW', 'GGGG')]:
+        #Nothing aligns with a positive score
+        aln = blast.smith_waterman(seq1, seq2)
+        assert aln.aln == ('', '')
+        assert aln.score == 0
+        assert aln.identity == aln.similarity == 0.
+        assert aln.registered_seq2 == '-'*len(seq1)
+
+def test_smith_waterman_long_target():
+    query = 'MKVLAAGIVW'
+    alns = blast.smith_waterman_kernel(query, ['MKVLAAGIVW', 'A'*50 + query], max_cells=200)
+    assert alns[0][:2] == (query, query)
+    #The second target needs 600 cells on its own and is skipped
+    assert alns[1] == ('', '', 0, 0, 0.)
+
+def test_iter_fasta():
+    lines = ["text before the first record is ignored", ">sp|P1.2 first", "MKVL", "  AAGIVW  ", "", ">P2 second\r", "MSTN", ">P3 empty"]
+    assert list(blast.iter_fasta(lines)) == [(">sp|P1.2 first", "MKVLAAGIVW"), (">P2 second", "MSTN"), (">P3 empty", "")]
+    assert list(blast.iter_fasta([])) == []
+    assert list(blast.iter_fasta(io.StringIO(">P1\nMKV\nLAA\n"))) == [(">P1", "MKVLAA")]
+
+def test_sequence_cache(tmp_path):
+    path = str(tmp_path / 'sequences.sqlite')
+    cache = blast.sequence_cache(path)
+    assert cache.get(['P1']) == {}
+    cache.put([(">P1.1 first", "MKVL"), (">P2 second", "MSTN")])
+    #Lookups ignore the version number and the leading '>'
+    assert cache.get(['P1.2', '>P2', 'P3']) == {'P1': (">P1.1 first", "MKVL"), 'P2': (">P2 second", "MSTN")}
+    #Later versions replace earlier ones and the store persists
+    cache.put([(">P1.2 first", "MKVLA")])
+    assert blast.sequence_cache(path).get(['P1']) == {'P1': (">P1.2 first", "MKVLA")}
+    #More keys than SQLite allows parameters in one query
+    cache.put((">Q{}".format(i), "M") for i in range(1200))
+    assert len(cache.get("Q{}".format(i) for i in range(1200))) == 1200
+
+def test_fetch_full_sequences(tmp_path, monkeypatch):
+    cache = blast.sequence_cache(str(tmp_path / 'sequences.sqlite'))
+    cache.put([(">A.1 protein A", "MKVLAAGIVW")])
+    requested = []
+    def efetch(uids):
+        requested.extend(uids)
+        yield ">B.2 protein B", "MRVL"
+        yield ">C.1 protein C", "MSTN"
+        raise IOError("connection lost")
+    monkeypatch.setattr(blast, 'efetch', efetch)
+    monkeypatch.setattr(blast, 'EfetchBatchSize', 1)
+    results = blast.blast_results(FixtureXML)
+    results.uids = ['A', 'B', 'C', 'D']
+    with pytest.raises(IOError):
+        results.fetch_full_sequences(cache)
+    #Only the missing sequences were requested and those that arrived before the error were kept
+    assert requested == ['B', 'C', 'D']
+    assert sorted(cache.get(['A', 'B', 'C', 'D'])) == ['A', 'B', 'C']
+
+    monkeypatch.setattr(blast, 'efetch', lambda uids: iter([]))
+    results.fetch_full_sequences(cache)
+    assert results.headers == (">A.1 protein A", ">B.2 protein B", ">C.1 protein C", None)
+    assert results.seqs == ("MKVLAAGIVW", "MRVL", "MSTN", '')
+
+def test_efetch_limiter_shared(monkeypatch):
+    class response():
+        def raise_for_status(self):
+            pass
+        def iter_lines(self, decode_unicode=False):
+            return iter([">P1", "MKVL"])
+    class limiter():
+        waits = 0
+        def wait(self):
+            limiter.waits += 1
+    monkeypatch.setattr(blast.requests, 'post', lambda *args, **kw: response())
+    monkeypatch.setattr(blast, 'EfetchLimiter', limiter())
+    #The rate limit holds across efetch calls, not just within one
+    assert list(blast.efetch(['P1'])) == [(">P1", "MKVL")]
+    assert list(blast.efetch(['P1', 'P2'], batch_size=1)) == [(">P1", "MKVL")]*2
+    assert limiter.waits == 3
+
+#A tiny protein database for the local backend
+LocalFASTA = """>P1 close match
+MKVLAAGIVWSTNQ
+>P2 distant match
+MKVIAAGLVW
+>P3 unrelated
+PPPPPPPP
+"""
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    #The in-repo aligner, whether or not blastp is installed
+    monkeypatch.setattr(blast.shutil, 'which', lambda name: None)
+    path = tmp_path / 'proteins.fasta'
+    path.write_text(LocalFASTA)
+    return str(path)
+
+def test_local_search(database, tmp_path):
+    path = str(tmp_path / 'RID.xml')
+    blast.local_search('MKVLAAGIVW', database, path)
+    results = blast.blast_results(open(path).read(), query='MKVLAAGIVW')
+    assert results.uids == ['P1', 'P2']
+    assert results.definitions == ['close match', 'distant match']
+    assert results.alignment[0].tobytes().decode() == 'MKVLAAGIVW'
+
+    blast.local_search('MKVLAAGIVW', database, path, hitlist_size=1)
+    assert blast.blast_results(open(path).read()).uids == ['P1']
+
+def test_local_search_multi_fasta(database, tmp_path):
+    path = str(tmp_path / 'RID.xml')
+    blast.local_search('>a\nMKVLAAGIVW\n>b\nPPPPPPPP\n', database, path)
+    first, second = blast.split_iterations(open(path).read(), ['MKVLAAGIVW', 'PPPPPPPP'])
+    assert first.uids == ['P1', 'P2']
+    assert second.uids == ['P3']
+
+def test_local_search_failed(tmp_path):
+    path = str(tmp_path / 'RID.xml')
+    with pytest.raises(IOError):
+        blast.local_search('MKVLAAGIVW', str(tmp_path / 'missing.fasta'), path)
+    assert not (tmp_path / 'RID.xml').exists()
+    assert 'FileNotFoundError' in (tmp_path / 'RID.err').read_text()
+
+def test_local_handle(database, tmp_path):
+    handle = blast.local_handle('MKVLAAGIVW', database, results_dir=str(tmp_path / 'results'))
+    with pytest.raises(TypeError):
+        handle.check_status()
+    rid, waittime = handle.request(QUERY='MKVLAAGIVW', HITLIST_SIZE=1)
+    assert rid.startswith('LOCAL-')
+    for i in range(200):
+        if handle.check_status():
+            break
+        time.sleep(0.05)
+    assert blast.blast_results(handle.fetch_result()).uids == ['P1']
+
+    handle = blast.local_handle('MKVLAAGIVW', str(tmp_path / 'missing.fasta'), results_dir=str(tmp_path / 'results'))
+    handle.request()
+    with pytest.raises(blast.SearchFailed):
+        for i in range(200):
+            handle.check_status()
+            time.sleep(0.05)
+
+def test_clean_local_results(tmp_path):
+    results_dir = tmp_path / 'results'
+    assert blast.clean_local_results(60, str(results_dir)) == 0
+    results_dir.mkdir()
+    old, new = results_dir / 'LOCAL-old.xml', results_dir / 'LOCAL-new.xml'
+    old.write_text('<BlastOutput/>')
+    new.write_text('<BlastOutput/>')
+    os.utime(str(old), (time.time() - 120, time.time() - 120))
+    assert blast.clean_local_results(60, str(results_dir)) == 1
+    assert not old.exists() and new.exists()
+
+def test_split_iterations():
+    hit = lambda accession,seq: {'accession': accession, 'definition': '', 'score': 40, 'query_from': 1, 'query_to': len(seq), 'qseq': seq, 'hseq': seq}
+    XML = blast.format_blast_xml([
+        ("Query_1", 4, [hit('A', 'MKVL'), hit('B', 'MKV')]),
+        ("Query_2", 5, []),
+        ("Query_3", 3, [hit('C', 'MST')]),
+    ])
+    first, second, third = blast.split_iterations(XML, ['MKVL', 'GGGGG', 'MST'])
+    assert first.uids == ['A', 'B']
+    assert (second.uids, second.sequence) == ([], 'GGGGG')
+    assert (third.uids, third.sequence) == (['C'], 'MST')
+    #Each matches reading its iteration on its own
+    assert (blast.blast_results(XML, iteration=2).alignment == third.alignment).all()
+
+    #Without queries the results run to the last iteration with hits. Extra queries get empty results.
+    assert [i.uids for i in blast.split_iterations(XML)] == [['A', 'B'], [], ['C']]
+    assert [i.uids for i in blast.split_iterations(XML, ['MKVL', 'GGGGG', 'MST', 'WWW'])] == [['A', 'B'], [], ['C'], []]
+
+def test_conservation_profile(monkeypatch):
+    rng = np.random.RandomState(3)
+    rows = [''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVWY-Xacgt*B'), 12)) for i in range(50)]
+    alignment = np.array([np.frombuffer(i.encode(), dtype=np.uint8) for i in rows])
+    weights = rng.uniform(1, 100, 50)
+    #Small chunks exercise the accumulation across chunks
+    monkeypatch.setattr(blast, 'ProfileChunkSize', 7)
+    for w in [None, weights]:
+        counts, frequencies, entropy = blast.conservation_profile(alignment, w)
+        expected = np.zeros((12, len(blast.ProfileAlphabet)))
+        for row,weight in zip(rows, np.ones(50) if w is None else w):
+            for position,residue in enumerate(row):
+                residue = residue.upper() if residue.upper() in blast.ProfileAlphabet[:20] else residue
+                expected[position, blast.ProfileAlphabet.index(residue) if residue in blast.ProfileAlphabet[:21] else -1] += weight
+        assert counts == pytest.approx(expected)
+        assert frequencies == pytest.approx(expected[:,:20]/expected[:,:20].sum(1, keepdims=True))
+        assert entropy == pytest.approx([-sum(p*np.log2(p) for p in i if p > 0) for i in frequencies])
+
+def test_conservation_profile_entropy():
+    alignment = np.array([np.frombuffer(i.encode(), dtype=np.uint8) for i in ['AAA-', 'ACA-', 'ADA-', 'AEAX']])
+    counts, frequencies, entropy = blast.conservation_profile(alignment)
+    #One residue, four equally common ones, and positions with no amino acids at all
+    assert entropy.tolist() == [0., 2., 0., 0.]
+    assert frequencies[3].tolist() == [0.]*20
+    assert counts[3, blast.ProfileAlphabet.index('-')] == 3
+    assert counts[3, -1] == 1
+
+    counts, frequencies, entropy = blast.conservation_profile(np.zeros((0, 5), dtype=np.uint8))
+    assert counts.shape == (5, len(blast.ProfileAlphabet))
+    assert entropy.tolist() == [0.]*5
@@ -0,0 +1,132 @@
+###############################################################################
+#                                                                             #
+# Tests of metrics.py. Run with pytest.                                       #
+#                                                                             #
+###############################################################################
+
+import pytest
+import metrics
+from tornado.testing import gen_test, AsyncTestCase
+
+#Metrics register themselves for good, so each test makes its own under a name of its own
+Names = iter(range(10**6))
+
+def new(kind, *args):
+    return kind('test_metric_{}'.format(next(Names)), *args)
+
+def lines(text, name):
+    """The sample lines of the metric name in the exposition text"""
+    return [i for i in text.split('\n') if i.split('{')[0].split(' ')[0] in (name, name + '_bucket', name + '_sum', name + '_count')]
+
+def test_counter():
+    c = new(metrics.counter, "Things counted")
+    c.inc(kind='a')
+    c.inc(2, kind='a')
+    c.inc()
+    text = metrics.exposition()
+    assert "# HELP {} Things counted".format(c.name) in text
+    assert "# TYPE {} counter".format(c.name) in text
+    assert lines(text, c.name) == ['{}{{kind="a"}} 3'.format(c.name), '{} 1'.format(c.name)]
+    with pytest.raises(ValueError):
+        metrics.counter(c.name, "The same name again")
+
+def test_escaping():
+    c = new(metrics.counter, "Help with a \\ and a\nline break")
+    c.inc(path='a"b\\c\nd')
+    text = metrics.exposition()
+    assert "# HELP {} Help with a \\\\ and a\\nline break".format(c.name) in text
+    assert lines(text, c.name) == ['{}{{path="a\\"b\\\\c\\nd"}} 1'.format(c.name)]
+
+def test_timer_buckets():
+    t = new(metrics.timer, "Durations")
+    t.observe(0.003, step='x')
+    t.observe(0.2, step='x')
+    t.observe(100., step='x')
+    samples = dict((i.split(' ')[0], float(i.split(' ')[1])) for i in lines(metrics.exposition(), t.name))
+    bucket = lambda le: samples['{}_bucket{{step="x",le="{}"}}'.format(t.name, le)]
+    #Buckets are cumulative: each counts every duration up to its bound
+    assert [bucket(le) for le in ['0.001', '0.0025', '0.005', '0.1', '0.25', '60.0', '+Inf']] == [0, 0, 1, 1, 2, 2, 3]
+    counts = [bucket('+Inf' if b == float('inf') else repr(b)) for b in metrics.Buckets]
+    assert counts == sorted(counts)
+    assert samples['{}_count{{step="x"}}'.format(t.name)] == 3
+    assert samples['{}_sum{{step="x"}}'.format(t.name)] == pytest.approx(100.203)
+
+def test_gauge():
+    g = new(metrics.gauge, "Queue length", lambda: {(('queue', 'a'),): 4, (('queue', 'b'),): 1.5})
+    assert lines(metrics.exposition(), g.name) == ['{}{{queue="a"}} 4'.format(g.name), '{}{{queue="b"}} 1.5'.format(g.name)]
+    g.fn = lambda: 7
+    assert lines(metrics.exposition(), g.name) == ['{} 7'.format(g.name)]
+
+def test_exposition_across_workers():
+    c = new(metrics.counter, "Requests")
+    g = new(metrics.gauge, "Pending", lambda: 2)
+    c.inc(handler='Main')
+    first = metrics.snapshot()
+    c.inc(handler='Main')
+    c.inc(handler='Batch')
+    second = metrics.snapshot()
+    #Snapshots travel between workers as JSON
+    assert metrics.decode(metrics.encode(second)) == second
+    text = metrics.exposition({(('worker', 0),): first, (('worker', 1),): metrics.decode(metrics.encode(second))})
+    assert lines(text, c.name) == [
+        '{}{{worker="0",handler="Main"}} 1'.format(c.name),
+        '{}{{worker="1",handler="Main"}} 2'.format(c.name),
+        '{}{{worker="1",handler="Batch"}} 1'.format(c.name),
+    ]
+    #Gauges are read once, not per worker
+    assert lines(text, g.name) == ['{} 2'.format(g.name)]
+
+def test_collect_merge():
+    c = new(metrics.counter, "Work done")
+    t = new(metrics.timer, "Work time")
+    def work(n):
+        c.inc(n, kind='task')
+        t.observe(0.01)
+        return n*2
+    c.inc(kind='task')
+    value, changes = metrics.collect(work, 5)
+    assert value == 10
+    #Only the increases made by work are collected
+    assert changes[c.name] == {(('kind', 'task'),): (5,)}
+    assert changes[t.name][()][-1] == 1
+    assert set(changes) == {c.name, t.name}
+
+    #Merged in another process they add to what is there
+    metrics.merge(changes)
+    assert c.state() == {(('kind', 'task'),): (11,)}
+    assert t.state()[()][-1] == 2
+    #Metrics this process does not have are skipped
+    metrics.merge({'test_metric_unknown': {(): (1,)}})
+    assert 'test_metric_unknown' not in metrics.Registry
+
+def test_collect_exception():
+    c = new(metrics.counter, "Failures")
+    def fail():
+        c.inc()
+        raise ValueError("broken")
+    with pytest.raises(ValueError) as error:
+        metrics.collect(fail)
+    assert error.value.metrics == {c.name: {(): (1,)}}
+
+class TimedTest(AsyncTestCase):
+    def test_timed(self):
+        t = new(metrics.timer, "Calls")
+        @metrics.timed(t, fn='add')
+        def add(a, b):
+            """Adds"""
+            return a + b
+        assert add(1, 2) == 3
+        assert add.__doc__ == "Adds"
+        with pytest.raises(TypeError):
+            add(1, None)
+        #Failed calls are timed too
+        assert t.state()[(('fn', 'add'),)][-1] == 2
+
+    @gen_test
+    async def test_timed_coroutine(self):
+        t = new(metrics.timer, "Coroutine calls")
+        @metrics.timed(t)
+        async def double(a):
+            return 2*a
+        assert await double(2) == 4
+        assert t.state()[()][-1] == 1
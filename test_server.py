@@ -0,0 +1,521 @@
+###############################################################################
+#                                                                             #
+# Tests of the request handling helpers in server.py. Run with pytest.        #
+#                                                                             #
+###############################################################################
+
+import json,time
+import pytest
+import blast, server, mock_ncbi
+from tornado.web import Application
+from tornado.httpclient import HTTPClientError
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+def fake_db():
+    """An empty in-process stand-in for the redis server. The tests using it are skipped without fakeredis."""
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+
+#One hit on a ten residue query
+ResultXML = blast.format_blast_xml([("Query_1", 10, [{
+    'accession'  : 'A',
+    'definition' : 'protein A',
+    'score'      : 40,
+    'query_from' : 2,
+    'query_to'   : 6,
+    'qseq'       : 'KVLAA',
+    'hseq'       : 'KVLGA',
+}])])
+
+class StatusHandler(mock_ncbi.BlastCGIHandler):
+    """
+    mock_ncbi's Blast.cgi which answers status checks with STATUS, a SearchInfo status or an http error, if it is 
+    set, and records the QUERY of every search in QUERIES
+    """
+    def initialize(self, **kw):
+        super().initialize(**kw)
+        self.status = kw['STATUS']
+        self.queries = kw['QUERIES']
+
+    def get(self):
+        if self.get_argument('CMD') == 'Put':
+            self.queries.append(self.get_argument('QUERY'))
+        if self.get_argument('CMD') == 'Get' and len(self.status) > 0:
+            if isinstance(self.status[0], int):
+                self.send_error(self.status[0])
+            else:
+                self.write(mock_ncbi.SearchInfoResponse.format(self.status[0]))
+            return
+        super().get()
+
+    post = get
+
+def test_sanitize():
+    assert server.sanitize("mkvlaagiv") == "MKVLAAGIV"
+    assert server.sanitize(">x\nMKVLA\nAGIV") == "MKVLAAGIV"
+
+def test_sanitize_blank_lines():
+    #Ordinary FASTA ends in a newline and may have blank lines between records
+    assert server.sanitize(">x\nMKVLAAGIV\n") == "MKVLAAGIV"
+    assert server.sanitize("\n>x\r\nMKVLA\n\n  \nAGIV\r\n") == "MKVLAAGIV"
+    assert server.sanitize("\n") == ""
+
+def test_result_cache():
+    import blast
+    value = blast.dumps(blast.blast_results('<BlastOutput></BlastOutput>', query='MKV'))
+    cache = server.ResultCache(maxsize=2)
+    assert cache.get('result:a') is None
+    a = cache.get('result:a', value)
+    assert cache.get('result:a') is a
+    cache.get('result:b', value)
+    #a was used more recently than b, so adding c evicts b
+    cache.get('result:a')
+    cache.get('result:c', value)
+    assert cache.get('result:b') is None
+    assert cache.get('result:a') is a
+    assert cache.get('result:c') is not None
+    assert len(cache.results) == 2
+
+class MockNCBITest(AsyncHTTPTestCase):
+    """Searches from a BlastScheduler on fakeredis go to StatusHandler, which returns self.xml for every search"""
+    interval = 10
+
+    def get_app(self):
+        self.status, self.xml, self.queries = [], ResultXML, []
+        self.db = fake_db()
+        self.scheduler = server.BlastScheduler(self.db, period=60, interval=self.interval, partial=0)
+        return Application([
+            (r"/blast/Blast.cgi", StatusHandler, {'SEARCHES': {}, 'XML': lambda: self.xml, 'STATUS': self.status, 'QUERIES': self.queries}),
+        ] + self.routes())
+
+    def routes(self):
+        return []
+
+    def setUp(self):
+        super().setUp()
+        self.saved = blast.BlastURL, server.new_handle, server.cpu_workers
+        blast.BlastURL = self.get_url('/blast/Blast.cgi')
+        server.new_handle = lambda query: blast.async_blast_handle(query, timeout=1., retries=0)
+        server.cpu_workers = 0
+
+    def tearDown(self):
+        blast.BlastURL, server.new_handle, server.cpu_workers = self.saved
+        super().tearDown()
+
+class SchedulerTest(MockNCBITest):
+    async def submit(self, seq='MKVLAAGIVW'):
+        """Claim and submit seq, make its RID due at once and return its uid and RID"""
+        uid, status = server.claim(self.db, seq)
+        assert status == 'claimed'
+        await server.submit(self.db, self.scheduler, [(uid, seq)])
+        rid = server.get_job(self.db, uid)['rid']
+        self.db.zadd("pending", {rid: time.time() - 1})
+        #Submitting took this worker's turn with NCBI
+        self.db.delete("ncbi:throttle")
+        return uid, rid
+
+    def test_waittime(self):
+        now = time.time()
+        self.scheduler.add('RID1', 'uid1', 300)
+        self.scheduler.add('RID2', ['uid2', 'uid3'], 5)
+        self.scheduler.add('RID3', 'uid4', 'unknown')
+        due = dict(self.db.zrange("pending", 0, -1, withscores=True))
+        #Never before WAITTIME and never sooner than the polling period
+        assert now + 300 <= due[b'RID1'] < now + 301
+        assert now + 60 <= due[b'RID2'] < now + 61
+        assert now + 60 <= due[b'RID3'] < now + 61
+        assert self.db.smembers("rid:RID2") == {b'uid2', b'uid3'}
+
+    @gen_test
+    async def test_ready(self):
+        uid, rid = await self.submit()
+        await self.scheduler.poll()
+        job = server.get_job(self.db, uid)
+        assert job['status'] == 'finished'
+        assert blast.loads(self.db.get(job['result'])).uids == ['A']
+        assert self.db.zcard("pending") == 0
+        assert not self.db.exists("rid:{}".format(rid))
+
+    @gen_test
+    async def test_one_check_per_interval(self):
+        self.status.append('WAITING')
+        first, rid1 = await self.submit('MKVLAAGIVW')
+        second, rid2 = await self.submit('MSTNPKPQRK')
+        await self.scheduler.poll()
+        await self.scheduler.poll()
+        #Only one RID was checked and rescheduled a polling period later, the other is still due
+        due = dict(self.db.zrange("pending", 0, -1, withscores=True))
+        assert len([i for i in due.values() if i > time.time() + 50]) == 1
+        assert len([i for i in due.values() if i < time.time()]) == 1
+        assert self.db.pttl("ncbi:throttle") > 9000
+
+    @gen_test
+    async def test_turn_taken_after_ownership(self):
+        #A RID nobody waits on any more is dropped without using up the turn
+        self.db.zadd("pending", {'ORPHAN': 0})
+        uid, rid = await self.submit()
+        await self.scheduler.poll()
+        assert server.job_status(self.db, uid) == 'finished'
+        assert self.db.zcard("pending") == 0
+
+    @gen_test
+    async def test_failed(self):
+        self.status.append('FAILED')
+        uid, rid = await self.submit()
+        pubsub = self.db.pubsub()
+        pubsub.subscribe("blast:{}".format(uid))
+        pubsub.get_message()
+        await self.scheduler.poll()
+        job = server.get_job(self.db, uid)
+        assert job['status'] == 'failed'
+        assert rid in job['error']
+        assert pubsub.get_message()['data'] == b'failed'
+        #The RID is forgotten and the sequence can be searched again
+        assert self.db.zcard("pending") == 0
+        assert not self.db.exists("rid:{}".format(rid))
+        assert server.claim(self.db, 'MKVLAAGIVW')[1] == 'claimed'
+
+    @gen_test
+    async def test_transient_error(self):
+        self.status.append(503)
+        uid, rid = await self.submit()
+        await self.scheduler.poll()
+        assert server.job_status(self.db, uid) == 'submitted'
+        due = self.db.zscore("pending", rid)
+        assert time.time() + 50 < due <= time.time() + 60
+
+        #The next check succeeds
+        self.status.clear()
+        self.db.zadd("pending", {rid: 0})
+        self.db.delete("ncbi:throttle")
+        await self.scheduler.poll()
+        assert server.job_status(self.db, uid) == 'finished'
+
+    @gen_test
+    async def test_unparsable_results(self):
+        self.xml = 'this is not xml'
+        uid, rid = await self.submit()
+        await self.scheduler.poll()
+        assert server.job_status(self.db, uid) == 'failed'
+
+def test_claim_joins_in_flight():
+    db = fake_db()
+    uid, status = server.claim(db, 'MKVLAAGIVW')
+    assert status == 'claimed'
+    assert server.claim(db, 'MKVLAAGIVW') == (uid, 'pending')
+    assert server.claim(db, 'MSTNPKPQRK')[1] == 'claimed'
+
+def test_claim_stored_result():
+    db = fake_db()
+    digest = server.search_digest('MKVLAAGIVW')
+    db.set("result:{}".format(digest), b'packed')
+    uid, status = server.claim(db, 'MKVLAAGIVW')
+    assert status == 'finished'
+    assert server.get_job(db, uid)['result'] == "result:{}".format(digest)
+    #Nothing is submitted for it
+    assert not db.exists("submission:{}".format(digest))
+
+def test_claim_race():
+    db = fake_db()
+    digest = server.search_digest('MKVLAAGIVW')
+    first, status = server.claim(db, 'MSTNPKPQRK')
+    #Another worker submits the same sequence between our lookup and our SET NX
+    set_ = db.set
+    def racing_set(key, value, **kw):
+        set_("submission:{}".format(digest), first)
+        return set_(key, value, **kw)
+    db.set = racing_set
+    uid, status = server.claim(db, 'MKVLAAGIVW')
+    assert (uid, status) == (first, 'pending')
+    #The provisional job record was withdrawn
+    assert len(db.keys(server.job_key('*'))) == 1
+
+def test_claim_after_failure():
+    db = fake_db()
+    uid, status = server.claim(db, 'MKVLAAGIVW')
+    server.fail_jobs(db, [uid], ValueError("broken"))
+    other, status = server.claim(db, 'MKVLAAGIVW')
+    assert status == 'claimed'
+    assert other != uid
+
+def test_fail_jobs():
+    db = fake_db()
+    uid, status = server.claim(db, 'MKVLAAGIVW')
+    other, status = server.claim(db, 'MSTNPKPQRK')
+    #Another job has since taken the submission of the second sequence
+    db.set("submission:{}".format(server.search_digest('MSTNPKPQRK')), 'newer')
+    server.fail_jobs(db, [uid, other, 'gone'], ValueError("broken"))
+    assert server.get_job(db, uid)['status'] == 'failed'
+    assert server.get_job(db, uid)['error'] == 'broken'
+    assert not db.exists("submission:{}".format(server.search_digest('MKVLAAGIVW')))
+    assert db.get("submission:{}".format(server.search_digest('MSTNPKPQRK'))) == b'newer'
+
+def test_fail_partial_jobs():
+    db = fake_db()
+    uid, status = server.claim(db, 'MKVLAAGIVW')
+    server.set_job(db, uid, status='partial', result='partial:a')
+    server.fail_jobs(db, [uid], ValueError("broken"))
+    #The top hits are kept and the job says why the rest will not arrive
+    job = server.get_job(db, uid)
+    assert (job['status'], job['result'], job['error']) == ('partial', 'partial:a', 'broken')
+    assert not db.exists("submission:{}".format(server.search_digest('MKVLAAGIVW')))
+
+def test_counted_redis():
+    db = server.CountedRedis(connection_pool=fake_db().connection_pool)
+    count = lambda command: server.REDIS_COMMANDS.state().get((('command', command),), (0,))[0]
+    before = count('set'), count('get'), count('hset')
+    db.set('a', 1)
+    assert db.get('a') == b'1'
+    #Commands in a pipeline are counted when it is sent
+    pipe = db.pipeline()
+    pipe.set('b', 2)
+    pipe.hset('c', 'field', 3)
+    assert (count('set'), count('hset')) == (before[0] + 1, before[2])
+    pipe.execute()
+    assert (count('set'), count('get'), count('hset')) == (before[0] + 2, before[1] + 1, before[2] + 1)
+    assert db.hget('c', 'field') == b'3'
+
+class NotifyTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.db = fake_db()
+        self.notifier = server.Notifier(self.db, retry_delay=0.)
+        self.notifier.io_loop = self.io_loop
+        return Application([
+            (r"/notify/(.*)", server.NotifyHandler, {'DB': self.db, 'NOTIFIER': self.notifier}),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.saved = server.client_refresh_period
+        server.client_refresh_period = 0.2
+
+    def tearDown(self):
+        server.client_refresh_period = self.saved
+        super().tearDown()
+
+    def connect(self, uid):
+        from tornado.websocket import websocket_connect
+        return websocket_connect(self.get_url('/notify/{}'.format(uid)).replace('http', 'ws'))
+
+    @gen_test
+    async def test_timeout(self):
+        uid, status = server.claim(self.db, 'MKVLAAGIVW')
+        socket = await self.connect(uid)
+        #Nothing happens to the search, so the server closes without a message after client_refresh_period
+        start = time.time()
+        assert await socket.read_message() is None
+        assert time.time() - start < 2
+        while self.notifier.watchers:
+            await gen.sleep(0.01)
+
+    @gen_test
+    async def test_resync_after_error(self):
+        uid, status = server.claim(self.db, 'MKVLAAGIVW')
+        socket = await self.connect(uid)
+        while uid not in self.notifier.watchers:
+            await gen.sleep(0.01)
+        #The search finishes while the pubsub connection is down, so its message is lost
+        server.set_job(self.db, uid, status='failed', error='broken')
+        self.notifier.on_error(ConnectionError("gone"), None, None)
+        assert await socket.read_message() == 'failed'
+
+class BatchTest(MockNCBITest):
+    interval = 0
+
+    def routes(self):
+        return [(r"/batch", server.BatchHandler, {'DB': self.db, 'SCHEDULER': self.scheduler})]
+
+    def post(self, body):
+        response = self.fetch('/batch', method='POST', body=json.dumps(body), raise_error=False)
+        return response.code, json.loads(response.body)
+
+    def test_status(self):
+        #Every entry reports the status of the job it joined
+        statuses = ['submitted', 'partial', 'finished', 'failed']
+        sequences = ['MKVLAAGIVW', 'MSTNPKPQRK', 'MAHHHHHHVG', 'MEEPQSDPSV']
+        for status,seq in zip(statuses, sequences):
+            uid, claimed = server.claim(self.db, seq)
+            server.set_job(self.db, uid, status=status)
+        code, body = self.post({'sequences': dict(zip(statuses, sequences))})
+        assert code == 200
+        assert {name: entry['status'] for name,entry in body['results'].items()} == {
+            'submitted': 'pending', 'partial': 'partial', 'finished': 'finished', 'failed': 'failed'}
+
+    def test_errors(self):
+        for body in ['not json', json.dumps({'sequence': 'MKV'}), json.dumps({'sequences': 'MKV'})]:
+            response = self.fetch('/batch', method='POST', body=body, raise_error=False)
+            assert response.code == 400
+            assert 'error' in json.loads(response.body)
+        code, body = self.post({'sequences': {'good': 'MKVLAAGIVW', 'bad': 'MKV1'}})
+        assert code == 400
+        assert body['invalid'] == ['bad']
+        assert self.queries == []
+
+    def test_iterations(self):
+        #Each query of the multi-FASTA search gets the hits of its own <Iteration>
+        sequences = ['MKVLAAGIVW', 'MSTNPKPQRK', 'MAHHHHHHVG']
+        self.xml = blast.format_blast_xml([("Query_{}".format(i), 10, [{
+            'accession': 'HIT{}'.format(i), 'definition': '', 'score': 40, 'query_from': 1, 'query_to': 10, 'qseq': seq, 'hseq': seq,
+        }]) for i,seq in enumerate(sequences)])
+        code, body = self.post({'sequences': sequences})
+        assert code == 200
+        assert len(self.queries) == 1
+        self.db.zadd("pending", {rid: 0 for rid in self.db.zrange("pending", 0, -1)})
+        self.io_loop.run_sync(self.scheduler.poll)
+        for i,entry in enumerate(body['results']):
+            job = server.get_job(self.db, entry['uid'])
+            assert (job['status'], job['iteration']) == ('finished', str(i))
+            assert blast.loads(self.db.get(job['result'])).uids == ['HIT{}'.format(i)]
+
+    def test_packing(self):
+        sequences = ['MKVLAAGIVW', 'MSTNPKPQRK', 'MAHHHHHHVG', 'MEEPQSDPSV', 'MGSSHHHHHH']
+        saved = server.batches.__defaults__
+        try:
+            #At most two queries or 25 residues per search
+            server.batches.__defaults__ = (2, 25)
+            code, body = self.post({'sequences': sequences[:4]})
+            assert [query.count('>') for query in self.queries] == [2, 2]
+            server.batches.__defaults__ = (10, 25)
+            code, body = self.post({'sequences': sequences[4:] + ['MKVLAAGIVWSTNPKPQRKW']})
+            #Together they are 30 residues, so each is searched as a bare sequence of its own
+            assert self.queries[2:] == ['MGSSHHHHHH', 'MKVLAAGIVWSTNPKPQRKW']
+        finally:
+            server.batches.__defaults__ = saved
+        uids = [entry['uid'] for entry in body['results']]
+        assert server.get_job(self.db, uids[0])['rid'] != server.get_job(self.db, uids[1])['rid']
+
+    def test_dedup(self):
+        #Repeated sequences, within a batch or since an earlier one, share one search
+        code, first = self.post({'sequences': ['MKVLAAGIVW']})
+        code, body = self.post({'sequences': ['MKVLAAGIVW', 'MSTNPKPQRK', 'mstnpkpqrk']})
+        uids = [entry['uid'] for entry in body['results']]
+        assert uids[0] == first['results'][0]['uid']
+        assert uids[1] == uids[2]
+        assert self.queries == ['MKVLAAGIVW', 'MSTNPKPQRK']
+
+def test_batches():
+    claims = [('a', 'M'*10), ('b', 'M'*10), ('c', 'M'*10), ('d', 'M'*30)]
+    assert [[uid for uid,seq in batch] for batch in server.batches(claims, 2, 100)] == [['a', 'b'], ['c', 'd']]
+    assert [[uid for uid,seq in batch] for batch in server.batches(claims, 10, 25)] == [['a', 'b'], ['c'], ['d']]
+    #A sequence longer than max_residues is searched on its own
+    assert list(server.batches([('e', 'M'*50)], 10, 25)) == [[('e', 'M'*50)]]
+    assert list(server.batches([], 10, 25)) == []
+
+class ResultTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.db = fake_db()
+        return Application([
+            (r"/sequence/([^/]+)/profile", server.ProfileHandler, {'DB': self.db}),
+            (r"/sequence/([^/]+)", server.SequenceHandler, {'DB': self.db}),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.saved = server.cpu_workers
+        server.cpu_workers = 0
+
+    def tearDown(self):
+        server.cpu_workers = self.saved
+        super().tearDown()
+
+    def store(self, key, status, lifetime=None):
+        """A job with the results of ResultXML under key, expiring after lifetime seconds"""
+        uid = 'uid-' + key
+        self.db.set(key, blast.dumps(blast.blast_results(ResultXML, query='MKVLAAGIVW')), ex=lifetime)
+        server.set_job(self.db, uid, status=status, result=key)
+        return uid
+
+    def test_profile(self):
+        uid = self.store('result:a', 'finished', 600)
+        response = self.fetch('/sequence/{}/profile'.format(uid))
+        assert response.headers['X-Result-Status'] == 'finished'
+        profile = json.loads(response.body)
+        assert (profile['sequence'], profile['hits'], profile['weighted']) == ('MKVLAAGIVW', 1, False)
+        assert json.loads(self.fetch('/sequence/{}/profile?weighted=1'.format(uid)).body)['weighted'] == True
+
+    def test_partial_lifetime(self):
+        #The profile of partial results expires with them and not result_lifetime later
+        uid = self.store('partial:a', 'partial', 60)
+        response = self.fetch('/sequence/{}/profile'.format(uid))
+        assert response.headers['X-Result-Status'] == 'partial'
+        assert 0 < self.db.ttl(server.profile_key('partial:a')) <= 60
+
+        #Results kept indefinitely, like the debug results, are profiled for result_lifetime
+        uid = self.store('result:debug', 'finished')
+        self.fetch('/sequence/{}/profile'.format(uid))
+        assert self.db.ttl(server.profile_key('result:debug')) > 60
+
+    def test_pending_and_failed(self):
+        server.set_job(self.db, 'waiting', status='submitted')
+        server.set_job(self.db, 'failed', status='failed')
+        assert self.fetch('/sequence/waiting/profile').code == 202
+        assert self.fetch('/sequence/failed/profile').code == 410
+        assert self.fetch('/sequence/missing/profile').code == 404
+
+    @gen_test
+    async def test_run_on_result(self):
+        #The status is read once, alongside the results
+        uid = self.store('partial:b', 'partial', 60)
+        status, sequence = await server.run_on_result(self.db, uid, server.result_sequence)
+        assert (status, sequence) == ('partial', 'MKVLAAGIVW')
+        server.set_job(self.db, 'waiting', status='submitted')
+        assert await server.run_on_result(self.db, 'waiting', server.result_sequence) == ('submitted', None)
+        assert await server.run_on_result(self.db, 'missing', server.result_sequence) == (None, None)
+
+    def test_sequence_page(self):
+        uid = self.store('partial:c', 'partial', 60)
+        assert b'while the rest download' in self.fetch('/sequence/{}'.format(uid)).body
+        #The rest of the search failed
+        server.set_job(self.db, uid, digest='c')
+        server.fail_jobs(self.db, [uid], ValueError("broken"))
+        body = self.fetch('/sequence/{}'.format(uid)).body
+        assert b'failed before the rest of its hits downloaded' in body
+        assert b'while the rest download' not in body
+        server.set_job(self.db, uid, status='finished')
+        assert b'top-scoring' not in self.fetch('/sequence/{}'.format(uid)).body
+
+class ExportTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.db = fake_db()
+        return Application([
+            (r"/sequence/([^/]+)/export", server.ExportHandler, {'DB': self.db}),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.saved = server.cpu_workers, server.export_page_size, server.run_on_result
+        server.cpu_workers, server.export_page_size = 0, 1
+        results = blast.blast_results(blast.format_blast_xml([("Query_1", 10, [{
+            'accession': 'HIT{}'.format(i), 'definition': 'protein {}'.format(i), 'score': 40 - i, 'query_from': 1, 'query_to': 10, 'qseq': 'MKVLAAGIVW', 'hseq': 'MKVLAAGIVW',
+        } for i in range(3)])]), query='MKVLAAGIVW')
+        self.db.set('partial:export', blast.dumps(results))
+        server.set_job(self.db, 'uid', status='partial', result='partial:export')
+
+    def tearDown(self):
+        server.cpu_workers, server.export_page_size, server.run_on_result = self.saved
+        server.RESULTS.results.clear()
+        super().tearDown()
+
+    def test_export(self):
+        response = self.fetch('/sequence/uid/export')
+        assert response.headers['X-Result-Status'] == 'partial'
+        assert response.body.decode().split('\n')[::2] == ['>Query', '>HIT0 protein 0', '>HIT1 protein 1', '>HIT2 protein 2', '']
+        assert self.fetch('/sequence/missing/export', raise_error=False).code == 404
+        assert self.fetch('/sequence/uid/export?format=xml', raise_error=False).code == 400
+
+    def test_truncated(self):
+        run_on_result, calls = server.run_on_result, []
+        async def finishing(db, uid, fn, *args):
+            #The rest of the search arrives after the first page is sent
+            calls.append(args)
+            if len(calls) == 2:
+                server.set_job(db, uid, status='finished', result='result:export')
+                db.set('result:export', db.get('partial:export'))
+            return await run_on_result(db, uid, fn, *args)
+        server.run_on_result = finishing
+        #The client sees an incomplete response rather than a short export
+        with pytest.raises(HTTPClientError) as error:
+            self.fetch('/sequence/uid/export')
+        assert error.value.code == 599
+        assert len(calls) == 2